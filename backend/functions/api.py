@@ -1,44 +1,95 @@
-import json
+import orjson
+import base64
+import asyncio
 import os
-import uuid
-from typing import List, Optional
+import time
+import hashlib
+import threading
+import anyio
+from typing import Any, Dict, List, Optional, Tuple
+from collections import defaultdict
 from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from mangum import Mangum
+from botocore.exceptions import ClientError
+from cachetools import TTLCache
 from datetime import datetime, timedelta
 
+# Use uvloop's event loop where it's available (not on Windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Import shared modules
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from shared.config import settings
+from shared import aws
 from shared.models import (
     UserCreate, UserLogin, UserResponse, TokenResponse,
     TaxProfileCreate, TaxProfileUpdate, TaxProfileResponse,
     ExpenseCreate, ExpenseUpdate, ExpenseResponse, ExpenseFilter,
-    ExpenseSummary, TaxReport, APIResponse, PaginatedResponse
+    ExpenseSummary, TaxReport, APIResponse, PaginatedResponse, ReceiptAnalysis, Location,
+    amount_to_cents, cents_to_amount, expense_amount_cents, new_id
 )
 from shared.database import db, DynamoKeys
 from shared.auth import auth_service
-from shared.ai_services import rekognition_service, llm_service, location_service
+from shared.ai_services import rekognition_service, llm_service, location_service, read_exif, slim_exif
+
+# Created once per container and reused across warm invocations
+_s3 = aws.client('s3')
 
 # Create FastAPI app
 app = FastAPI(
     title="Taxless API",
     description="AI-powered expense tracking for tax purposes",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure appropriately for production
+    allow_origins=[settings.frontend_origin],
     allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
 
+# Handlers doing blocking boto3 work are plain `def` and run in this threadpool
+THREADPOOL_SIZE = 200
+
+
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+
+# AWS error codes that map to something more specific than a 500
+CLIENT_ERROR_STATUS = {
+    'ConditionalCheckFailedException': 409,
+    'ResourceNotFoundException': 404,
+    'ProvisionedThroughputExceededException': 503,
+    'ThrottlingException': 503,
+}
+
+
+@app.exception_handler(ClientError)
+async def client_error_handler(request, exc: ClientError):
+    """Convert boto3 errors into HTTP responses without leaking their details"""
+    code = exc.response.get('Error', {}).get('Code', 'Unknown')
+    return ORJSONResponse(
+        status_code=CLIENT_ERROR_STATUS.get(code, 500),
+        content={"detail": code}
+    )
+
+
 # Dependency to get current user from token
 async def get_current_user(authorization: str = Query(..., description="Bearer token")):
     if not authorization.startswith("Bearer "):
@@ -53,404 +104,526 @@ async def get_current_user(authorization: str = Query(..., description="Bearer t
     return token_data
 
 
+# (parameter, attribute, operator) for each supported expense filter
+_FILTER_FIELDS = (
+    ("profile_id", "profile_id", "="),
+    ("category", "category", "="),
+    ("date_from", "date", ">="),
+    ("date_to", "date", "<="),
+    ("tags", "tags", "contains"),
+)
+
+
+def _build_filter(**values) -> Tuple[Optional[str], Dict[str, str], Dict[str, Any]]:
+    """Build a filter expression and its attribute names/values; list values become IN clauses
+    
+    For "contains" fields a list matches items holding any of the values.
+    """
+    filter_parts = []
+    expression_attrs = {}
+    expression_values = {}
+    
+    for param, attr, operator in _FILTER_FIELDS:
+        value = values.get(param)
+        if not value:
+            continue
+        
+        expression_attrs[f"#{attr}"] = attr
+        if operator == "contains":
+            value = value if isinstance(value, list) else [value]
+            placeholders = [f":{param}{i}" for i in range(len(value))]
+            filter_parts.append("(" + " OR ".join(f"contains(#{attr}, {p})" for p in placeholders) + ")")
+            expression_values.update(zip(placeholders, value))
+        elif isinstance(value, list):
+            placeholders = [f":{param}{i}" for i in range(len(value))]
+            filter_parts.append(f"#{attr} IN ({', '.join(placeholders)})")
+            expression_values.update(zip(placeholders, value))
+        else:
+            filter_parts.append(f"#{attr} {operator} :{param}")
+            expression_values[f":{param}"] = value
+    
+    filter_expression = " AND ".join(filter_parts) if filter_parts else None
+    return filter_expression, expression_attrs, expression_values
+
+
+# Tax profiles rarely change, so keep each user's profiles for a short while
+_profile_cache = TTLCache(maxsize=5000, ttl=60)
+_profile_cache_lock = threading.Lock()
+
+
+def _get_user_profiles(user_id: str) -> List[Dict[str, Any]]:
+    """Get a user's tax profile records, served from the in-process cache when fresh"""
+    with _profile_cache_lock:
+        profiles = _profile_cache.get(user_id)
+    if profiles is not None:
+        return profiles
+    
+    result = db.query_items(
+        pk=DynamoKeys.user_key(user_id),
+        sk_prefix="PROFILE#"
+    )
+    profiles = result['items']
+    
+    with _profile_cache_lock:
+        _profile_cache[user_id] = profiles
+    return profiles
+
+
+def _invalidate_user_profiles(user_id: str):
+    """Drop a user's cached tax profiles after a write"""
+    with _profile_cache_lock:
+        _profile_cache.pop(user_id, None)
+
+
+def _expense_response(item: Dict[str, Any]) -> ExpenseResponse:
+    """Build an ExpenseResponse from a stored expense, converting cents back to an amount"""
+    location = item.get('location')
+    return ExpenseResponse.model_construct(**{
+        **item,
+        'amount': cents_to_amount(expense_amount_cents(item)),
+        # Nested models aren't built by model_construct; the serializer expects a Location
+        'location': Location.model_construct(**location) if location else None,
+        # Tags are stored as a string set (older items: a list); responses carry a stable list
+        'tags': sorted(item.get('tags') or ())
+    })
+
+
+def _query_user_expenses(user_id: str, profile_id: Optional[str] = None, **query_kwargs):
+    """Query a user's expenses, going through GSI1 (user, profile#date) when scoped to a profile"""
+    if profile_id:
+        return db.query_gsi(
+            gsi_name="GSI1",
+            gsi_pk=DynamoKeys.user_key(user_id),
+            gsi_sk_prefix=DynamoKeys.expense_by_profile_sk(profile_id, ""),
+            **query_kwargs
+        )
+    
+    return db.query_items(
+        pk=DynamoKeys.user_key(user_id),
+        sk_prefix="EXPENSE#",
+        **query_kwargs
+    )
+
+
+def _iter_user_expenses(user_id: str, profile_id: Optional[str] = None, **query_kwargs):
+    """Stream every matching expense across all pages; same index choice as _query_user_expenses"""
+    if profile_id:
+        return db.iter_query_gsi(
+            gsi_name="GSI1",
+            gsi_pk=DynamoKeys.user_key(user_id),
+            gsi_sk_prefix=DynamoKeys.expense_by_profile_sk(profile_id, ""),
+            **query_kwargs
+        )
+    
+    return db.iter_query(
+        pk=DynamoKeys.user_key(user_id),
+        sk_prefix="EXPENSE#",
+        **query_kwargs
+    )
+
+
+def _encode_cursor(last_evaluated_key: Optional[dict]) -> Optional[str]:
+    """Encode a DynamoDB LastEvaluatedKey as an opaque pagination cursor"""
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(orjson.dumps(last_evaluated_key)).decode()
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[dict]:
+    """Decode a pagination cursor back into a DynamoDB ExclusiveStartKey"""
+    if not cursor:
+        return None
+    try:
+        return orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Receipt analyses are cached by image SHA-256 for 30 days
+ANALYSIS_CACHE_TTL = 30 * 86400
+
+
+def _download_receipt(file_key: str) -> bytes:
+    """Download a receipt image from S3"""
+    response = _s3.get_object(Bucket=settings.s3_bucket, Key=file_key)
+    return response['Body'].read()
+
+
 # Authentication endpoints
 @app.post("/auth/register", response_model=APIResponse)
-async def register_user(user_data: UserCreate):
+def register_user(user_data: UserCreate):
     """Register a new user"""
-    try:
-        # Create user in Cognito
-        user_id = auth_service.create_user_cognito(user_data)
-        if not user_id:
-            raise HTTPException(status_code=400, detail="Failed to create user")
-        
-        # Create user record in DynamoDB
-        user_record = {
-            'id': user_id,
-            'email': user_data.email,
-            'first_name': user_data.first_name,
-            'last_name': user_data.last_name,
-            'phone': user_data.phone,
-            'is_active': True
-        }
-        
-        db.create_item(
-            pk=DynamoKeys.user_key(user_id),
-            sk=DynamoKeys.user_key(user_id),
-            item_data=user_record
-        )
-        
-        return APIResponse(
-            success=True,
-            message="User registered successfully",
-            data={"user_id": user_id}
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Create user in Cognito
+    user_id = auth_service.create_user_cognito(user_data)
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Failed to create user")
+    
+    # Create user record in DynamoDB
+    user_record = {
+        'id': user_id,
+        'email': user_data.email,
+        'first_name': user_data.first_name,
+        'last_name': user_data.last_name,
+        'phone': user_data.phone,
+        'is_active': True
+    }
+    
+    db.create_item(
+        pk=DynamoKeys.user_key(user_id),
+        sk=DynamoKeys.user_key(user_id),
+        item_data=user_record
+    )
+    
+    return APIResponse(
+        success=True,
+        message="User registered successfully",
+        data={"user_id": user_id}
+    )
 
 
 @app.post("/auth/login", response_model=APIResponse)
-async def login_user(login_data: UserLogin):
+def login_user(login_data: UserLogin):
     """Login user and return tokens"""
-    try:
-        # Authenticate with Cognito
-        auth_result = auth_service.authenticate_user_cognito(login_data.email, login_data.password)
-        if not auth_result:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        # Get user info
-        user_info = auth_service.get_user_cognito(login_data.email)
-        if not user_info:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        return APIResponse(
-            success=True,
-            message="Login successful",
-            data={
-                "access_token": auth_result['access_token'],
-                "refresh_token": auth_result['refresh_token'],
-                "expires_in": auth_result['expires_in'],
-                "user": user_info
-            }
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Authenticate with Cognito
+    auth_result = auth_service.authenticate_user_cognito(login_data.email, login_data.password)
+    if not auth_result:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    # Get user info
+    user_info = auth_service.get_user_cognito(login_data.email)
+    if not user_info:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    return APIResponse(
+        success=True,
+        message="Login successful",
+        data={
+            "access_token": auth_result['access_token'],
+            "refresh_token": auth_result['refresh_token'],
+            "expires_in": auth_result['expires_in'],
+            "user": user_info
+        }
+    )
 
 
 @app.post("/auth/refresh", response_model=APIResponse)
-async def refresh_token(refresh_token: str = Form(...)):
+def refresh_token(refresh_token: str = Form(...)):
     """Refresh access token"""
-    try:
-        result = auth_service.refresh_token_cognito(refresh_token)
-        if not result:
-            raise HTTPException(status_code=401, detail="Invalid refresh token")
-        
-        return APIResponse(
-            success=True,
-            message="Token refreshed successfully",
-            data=result
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = auth_service.refresh_token_cognito(refresh_token)
+    if not result:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    return APIResponse(
+        success=True,
+        message="Token refreshed successfully",
+        data=result
+    )
 
 
 # Tax Profile endpoints
 @app.get("/profiles", response_model=APIResponse)
-async def get_tax_profiles(current_user = Depends(get_current_user)):
+def get_tax_profiles(current_user = Depends(get_current_user)):
     """Get all tax profiles for the current user"""
-    try:
-        result = db.query_items(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk_prefix="PROFILE#"
-        )
-        
-        profiles = []
-        for item in result['items']:
-            profiles.append(TaxProfileResponse(**item))
-        
-        return APIResponse(
-            success=True,
-            message="Tax profiles retrieved successfully",
-            data=profiles
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Rows are server-written, so skip re-validating them
+    profiles = []
+    for item in _get_user_profiles(current_user.user_id):
+        profiles.append(TaxProfileResponse.model_construct(**item))
+    
+    return APIResponse(
+        success=True,
+        message="Tax profiles retrieved successfully",
+        data=profiles
+    )
 
 
 @app.post("/profiles", response_model=APIResponse)
-async def create_tax_profile(
+def create_tax_profile(
     profile_data: TaxProfileCreate,
     current_user = Depends(get_current_user)
 ):
     """Create a new tax profile"""
-    try:
-        profile_record = {
-            'id': profile_data.id,
-            'user_id': current_user.user_id,
-            'name': profile_data.name,
-            'profile_type': profile_data.profile_type,
-            'default_currency': profile_data.default_currency,
-            'tax_year': profile_data.tax_year,
-            'business_number': profile_data.business_number,
-            'address': profile_data.address,
-            'description': profile_data.description
-        }
-        
-        db.create_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.profile_key(current_user.user_id, profile_data.id),
-            item_data=profile_record
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Tax profile created successfully",
-            data=TaxProfileResponse(**profile_record)
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    profile_id = new_id()
+    profile_record = {
+        'id': profile_id,
+        'user_id': current_user.user_id,
+        'name': profile_data.name,
+        'profile_type': profile_data.profile_type,
+        'default_currency': profile_data.default_currency,
+        'tax_year': profile_data.tax_year,
+        'business_number': profile_data.business_number,
+        'address': profile_data.address,
+        'description': profile_data.description
+    }
+    
+    created = db.create_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.profile_key(current_user.user_id, profile_id),
+        item_data=profile_record
+    )
+    _invalidate_user_profiles(current_user.user_id)
+    
+    return APIResponse(
+        success=True,
+        message="Tax profile created successfully",
+        data=TaxProfileResponse.model_construct(**created)
+    )
 
 
 @app.put("/profiles/{profile_id}", response_model=APIResponse)
-async def update_tax_profile(
+def update_tax_profile(
     profile_id: str,
     profile_data: TaxProfileUpdate,
     current_user = Depends(get_current_user)
 ):
     """Update a tax profile"""
-    try:
-        updates = profile_data.dict(exclude_unset=True)
-        
-        result = db.update_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.profile_key(current_user.user_id, profile_id),
-            updates=updates
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Tax profile updated successfully",
-            data=TaxProfileResponse(**result)
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    updates = profile_data.model_dump(exclude_unset=True)
+    
+    result = db.update_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.profile_key(current_user.user_id, profile_id),
+        updates=updates
+    )
+    _invalidate_user_profiles(current_user.user_id)
+    
+    return APIResponse(
+        success=True,
+        message="Tax profile updated successfully",
+        data=TaxProfileResponse.model_construct(**result)
+    )
 
 
 @app.delete("/profiles/{profile_id}", response_model=APIResponse)
-async def delete_tax_profile(
+def delete_tax_profile(
     profile_id: str,
     current_user = Depends(get_current_user)
 ):
     """Delete a tax profile"""
-    try:
-        db.delete_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.profile_key(current_user.user_id, profile_id)
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Tax profile deleted successfully"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    db.delete_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.profile_key(current_user.user_id, profile_id)
+    )
+    _invalidate_user_profiles(current_user.user_id)
+    
+    return APIResponse(
+        success=True,
+        message="Tax profile deleted successfully"
+    )
 
 
 # Expense endpoints
 @app.get("/expenses", response_model=APIResponse)
-async def get_expenses(
+def get_expenses(
     profile_id: Optional[str] = Query(None),
     category: Optional[str] = Query(None),
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    page: int = Query(1, ge=1, description="Page number, for display only"),
     page_size: int = Query(20, ge=1, le=100),
     current_user = Depends(get_current_user)
 ):
     """Get expenses with optional filtering"""
-    try:
-        # Build filter expression
-        filter_parts = []
-        expression_attrs = {}
-        expression_values = {}
-        
-        if profile_id:
-            filter_parts.append("#profile_id = :profile_id")
-            expression_attrs["#profile_id"] = "profile_id"
-            expression_values[":profile_id"] = profile_id
-        
-        if category:
-            filter_parts.append("#category = :category")
-            expression_attrs["#category"] = "category"
-            expression_values[":category"] = category
-        
-        if date_from:
-            filter_parts.append("#date >= :date_from")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_from"] = date_from
-        
-        if date_to:
-            filter_parts.append("#date <= :date_to")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_to"] = date_to
-        
-        filter_expression = " AND ".join(filter_parts) if filter_parts else None
-        
-        result = db.scan_items(
+    start_key = _decode_cursor(cursor)
+    
+    # Build filter expression (profile is part of the index key)
+    filter_expression, expression_attrs, expression_values = _build_filter(
+        category=category, date_from=date_from, date_to=date_to
+    )
+    
+    # Limit applies before the filter, so keep reading until the page is full.
+    # Never ask for more than the remaining slots so the cursor can't skip items.
+    items = []
+    while True:
+        result = _query_user_expenses(
+            current_user.user_id,
+            profile_id,
             filter_expression=filter_expression,
             expression_attribute_names=expression_attrs,
             expression_attribute_values=expression_values,
-            limit=page_size,
-            start_key=None  # Add pagination support
+            limit=page_size - len(items),
+            start_key=start_key
         )
+        items.extend(result['items'])
+        start_key = result['last_evaluated_key']
         
-        expenses = [ExpenseResponse(**item) for item in result['items']]
-        
-        return APIResponse(
-            success=True,
-            message="Expenses retrieved successfully",
-            data=PaginatedResponse(
-                items=expenses,
-                total=result['count'],
-                page=page,
-                page_size=page_size,
-                has_next=result['has_more'],
-                has_prev=page > 1
-            )
+        if not start_key or len(items) >= page_size:
+            break
+    
+    expenses = [_expense_response(item) for item in items]
+    
+    return APIResponse(
+        success=True,
+        message="Expenses retrieved successfully",
+        data=PaginatedResponse(
+            items=expenses,
+            total=len(expenses),
+            page=page,
+            page_size=page_size,
+            has_next=start_key is not None,
+            has_prev=cursor is not None,
+            next_cursor=_encode_cursor(start_key)
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    )
 
 
 @app.post("/expenses", response_model=APIResponse)
-async def create_expense(
+def create_expense(
     expense_data: ExpenseCreate,
     current_user = Depends(get_current_user)
 ):
     """Create a new expense"""
-    try:
-        expense_record = {
-            'id': expense_data.id,
-            'user_id': current_user.user_id,
-            'profile_id': expense_data.profile_id,
-            'amount': expense_data.amount,
-            'currency': expense_data.currency,
-            'description': expense_data.description,
-            'category': expense_data.category,
-            'date': expense_data.date.isoformat(),
-            'location': expense_data.location.dict() if expense_data.location else None,
-            'tax_eligibility': expense_data.tax_eligibility,
-            'notes': expense_data.notes,
-            'tags': expense_data.tags,
-            'receipt_ids': expense_data.receipt_ids,
-            'is_verified': False
-        }
-        
-        db.create_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.expense_key(current_user.user_id, expense_data.id),
-            item_data=expense_record
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Expense created successfully",
-            data=ExpenseResponse(**expense_record)
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    expense_id = new_id()
+    expense_record = {
+        'id': expense_id,
+        'user_id': current_user.user_id,
+        'profile_id': expense_data.profile_id,
+        'amount_cents': amount_to_cents(expense_data.amount),
+        'currency': expense_data.currency,
+        'description': expense_data.description,
+        'category': expense_data.category,
+        'date': expense_data.date.isoformat(),
+        'location': expense_data.location.model_dump() if expense_data.location else None,
+        'tax_eligibility': expense_data.tax_eligibility,
+        'notes': expense_data.notes,
+        'tags': expense_data.tags,
+        'receipt_ids': expense_data.receipt_ids,
+        'is_verified': False,
+        'verification_status': 'UNVERIFIED',
+        'gsi1pk': DynamoKeys.user_key(current_user.user_id),
+        'gsi1sk': DynamoKeys.expense_by_profile_sk(expense_data.profile_id, expense_data.date.isoformat())
+    }
+    
+    created = db.create_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.expense_key(current_user.user_id, expense_id),
+        item_data=expense_record
+    )
+    
+    return APIResponse(
+        success=True,
+        message="Expense created successfully",
+        data=_expense_response(created)
+    )
 
 
 @app.put("/expenses/{expense_id}", response_model=APIResponse)
-async def update_expense(
+def update_expense(
     expense_id: str,
     expense_data: ExpenseUpdate,
     current_user = Depends(get_current_user)
 ):
     """Update an expense"""
-    try:
-        updates = expense_data.dict(exclude_unset=True)
-        
-        # Convert datetime to string if present
-        if 'date' in updates and updates['date']:
-            updates['date'] = updates['date'].isoformat()
-        
-        # Convert location to dict if present
-        if 'location' in updates and updates['location']:
-            updates['location'] = updates['location'].dict()
-        
-        result = db.update_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.expense_key(current_user.user_id, expense_id),
-            updates=updates
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Expense updated successfully",
-            data=ExpenseResponse(**result)
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    updates = expense_data.model_dump(exclude_unset=True)
+    
+    # Amounts are stored as integer cents
+    if updates.get('amount') is not None:
+        updates['amount_cents'] = amount_to_cents(updates.pop('amount'))
+    
+    pk = DynamoKeys.user_key(current_user.user_id)
+    sk = DynamoKeys.expense_key(current_user.user_id, expense_id)
+    
+    # Convert datetime to string if present
+    if 'date' in updates and updates['date']:
+        updates['date'] = updates['date'].isoformat()
+        
+        # Keep the profile/date index key in step with the date, in the same write.
+        # The key embeds the profile id, which updates don't carry.
+        expense = db.get_item(pk, sk)
+        if not expense:
+            raise HTTPException(status_code=404, detail="Expense not found")
+        updates['gsi1sk'] = DynamoKeys.expense_by_profile_sk(expense['profile_id'], updates['date'])
+    
+    result = db.update_item(pk=pk, sk=sk, updates=updates)
+    
+    return APIResponse(
+        success=True,
+        message="Expense updated successfully",
+        data=_expense_response(result)
+    )
 
 
 @app.delete("/expenses/{expense_id}", response_model=APIResponse)
-async def delete_expense(
+def delete_expense(
     expense_id: str,
     current_user = Depends(get_current_user)
 ):
     """Delete an expense"""
-    try:
-        db.delete_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.expense_key(current_user.user_id, expense_id)
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Expense deleted successfully"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    db.delete_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.expense_key(current_user.user_id, expense_id)
+    )
+    
+    return APIResponse(
+        success=True,
+        message="Expense deleted successfully"
+    )
 
 
 # Receipt upload and analysis endpoints
 @app.post("/expenses/upload", response_model=APIResponse)
-async def upload_receipt(
+def upload_receipt(
     file: UploadFile = File(...),
     profile_id: str = Form(...),
     current_user = Depends(get_current_user)
 ):
     """Upload a receipt image for analysis"""
+    # Validate file type
+    if file.content_type not in settings.supported_image_types:
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+    
+    # Determine size without buffering the upload in memory
+    file_size = file.size
+    if file_size is None:
+        file.file.seek(0, os.SEEK_END)
+        file_size = file.file.tell()
+    file.file.seek(0)
+    
+    if file_size > settings.max_file_size_mb * 1024 * 1024:
+        raise HTTPException(status_code=400, detail="File too large")
+    
+    # Generate file key; the receipt id is embedded so the S3 event can find the record directly
+    receipt_id = new_id()
+    file_key = f"uploads/{current_user.user_id}/{datetime.utcnow().strftime('%Y/%m/%d')}/{receipt_id}/{file.filename}"
+    
+    # Create receipt record before the upload so it exists when the S3 event fires
+    receipt_record = {
+        'id': receipt_id,
+        'user_id': current_user.user_id,
+        'file_key': file_key,
+        'file_size': file_size,
+        'content_type': file.content_type,
+        'is_processed': False
+    }
+    
+    db.create_item(
+        pk=DynamoKeys.user_key(current_user.user_id),
+        sk=DynamoKeys.receipt_key(current_user.user_id, receipt_record['id']),
+        item_data=receipt_record
+    )
+    
+    # Stream to S3 from the spooled upload file
     try:
-        # Validate file type
-        if file.content_type not in settings.supported_image_types:
-            raise HTTPException(status_code=400, detail="Unsupported file type")
-        
-        # Read file content
-        file_content = await file.read()
-        
-        if len(file_content) > settings.max_file_size_mb * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large")
-        
-        # Generate file key
-        file_key = f"uploads/{current_user.user_id}/{datetime.utcnow().strftime('%Y/%m/%d')}/{file.filename}"
-        
-        # Upload to S3
-        import boto3
-        s3_client = boto3.client('s3', region_name=settings.aws_region)
-        s3_client.put_object(
-            Bucket=settings.s3_bucket,
-            Key=file_key,
-            Body=file_content,
-            ContentType=file.content_type
+        _s3.upload_fileobj(
+            file.file,
+            settings.s3_bucket,
+            file_key,
+            ExtraArgs={'ContentType': file.content_type}
         )
-        
-        # Create receipt record
-        receipt_record = {
-            'id': str(uuid.uuid4()),
-            'user_id': current_user.user_id,
-            'file_key': file_key,
-            'file_size': len(file_content),
-            'content_type': file.content_type,
-            'is_processed': False
-        }
-        
-        db.create_item(
+    except Exception:
+        db.delete_item(
             pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.receipt_key(current_user.user_id, receipt_record['id']),
-            item_data=receipt_record
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Receipt uploaded successfully",
-            data={
-                "receipt_id": receipt_record['id'],
-                "file_key": file_key
-            }
+            sk=DynamoKeys.receipt_key(current_user.user_id, receipt_id)
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise
+    
+    return APIResponse(
+        success=True,
+        message="Receipt uploaded successfully",
+        data={
+            "receipt_id": receipt_record['id'],
+            "file_key": file_key
+        }
+    )
 
 
 @app.post("/expenses/analyze", response_model=APIResponse)
@@ -459,40 +632,43 @@ async def analyze_receipt(
     current_user = Depends(get_current_user)
 ):
     """Analyze a receipt using OCR and LLM"""
+    # Blocking boto3 and LLM calls run on the executor to keep the event loop free
+    loop = asyncio.get_running_loop()
+    pk = DynamoKeys.user_key(current_user.user_id)
+    sk = DynamoKeys.receipt_key(current_user.user_id, receipt_id)
+    
+    # Get receipt record; the S3 key is only known once it's loaded
+    receipt = await loop.run_in_executor(None, db.get_item, pk, sk)
+    
+    if not receipt:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    
+    # Download from S3
+    image_bytes = await loop.run_in_executor(None, _download_receipt, receipt['file_key'])
+    
+    # Start OCR for the common cache-miss case, and extract EXIF data, while checking
+    # for a previous analysis of the same image
+    ocr_future = loop.run_in_executor(None, rekognition_service.detect_text, image_bytes)
+    cache_key = DynamoKeys.analysis_cache_key(hashlib.sha256(image_bytes).hexdigest())
     try:
-        # Get receipt record
-        receipt = db.get_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.receipt_key(current_user.user_id, receipt_id)
-        )
-        
-        if not receipt:
-            raise HTTPException(status_code=404, detail="Receipt not found")
-        
-        # Download from S3
-        import boto3
-        s3_client = boto3.client('s3', region_name=settings.aws_region)
-        response = s3_client.get_object(
-            Bucket=settings.s3_bucket,
-            Key=receipt['file_key']
-        )
-        image_bytes = response['Body'].read()
-        
-        # Extract EXIF data
-        import exifread
-        from PIL import Image
-        import io
-        
-        image = Image.open(io.BytesIO(image_bytes))
-        exif_data = {}
-        if hasattr(image, '_getexif') and image._getexif():
-            exif_data = exifread.process_file(io.BytesIO(image_bytes))
-        
-        # Extract location from EXIF
-        location = location_service.extract_location_from_exif(exif_data)
-        
-        # Perform OCR
-        ocr_result = rekognition_service.detect_text(image_bytes)
+        exif_data, cached = await asyncio.gather(
+            loop.run_in_executor(None, read_exif, image_bytes),
+            # Analyses are keyed by image content and never change, so the read cache is safe here
+            loop.run_in_executor(None, db.get_item, cache_key, cache_key, True)
+        )
+    except BaseException:
+        ocr_future.cancel()
+        raise
+    
+    # Extract location from EXIF
+    location = location_service.extract_location_from_exif(exif_data)
+    
+    if cached:
+        # The OCR result isn't needed; drop it rather than wait for it
+        ocr_future.cancel()
+        analysis = ReceiptAnalysis(**cached['analysis'])
+    else:
+        ocr_result = await ocr_future
         if not ocr_result['success']:
             raise HTTPException(status_code=500, detail="OCR failed")
         
@@ -500,169 +676,146 @@ async def analyze_receipt(
         ocr_text = ' '.join([block['text'] for block in ocr_result['text_blocks']])
         
         # Analyze with LLM
-        analysis = llm_service.analyze_receipt(ocr_text, {
+        analysis = await llm_service.analyze_receipt_async(ocr_text, {
             'file_size': receipt['file_size'],
             'content_type': receipt['content_type'],
-            'exif_data': exif_data
+            'exif_data': slim_exif(exif_data)
         })
         
-        # Update receipt with analysis
-        db.update_item(
-            pk=DynamoKeys.user_key(current_user.user_id),
-            sk=DynamoKeys.receipt_key(current_user.user_id, receipt_id),
-            updates={
-                'analysis': analysis.dict(),
-                'is_processed': True
-            }
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Receipt analyzed successfully",
-            data={
-                "receipt_id": receipt_id,
-                "analysis": analysis.dict(),
-                "location": location.dict() if location else None
-            }
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        # Cache the analysis; DynamoDB TTL evicts it via the ttl attribute
+        await loop.run_in_executor(None, db.create_item, cache_key, cache_key, {
+            'analysis': analysis.model_dump(),
+            'ttl': int(time.time()) + ANALYSIS_CACHE_TTL
+        })
+    
+    # Update receipt with analysis, unless it was deleted while we were analyzing
+    try:
+        await loop.run_in_executor(None, db.update_item, pk, sk, {
+            'analysis': analysis.model_dump(),
+            'is_processed': True
+        }, 'attribute_exists(pk)')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise HTTPException(status_code=404, detail="Receipt not found")
+        raise
+    
+    return APIResponse(
+        success=True,
+        message="Receipt analyzed successfully",
+        data={
+            "receipt_id": receipt_id,
+            "analysis": analysis.model_dump(),
+            "location": location.model_dump() if location else None
+        }
+    )
 
 
 # Reporting endpoints
 @app.get("/reports/summary", response_model=APIResponse)
-async def get_expense_summary(
+def get_expense_summary(
     profile_id: Optional[str] = Query(None),
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
     current_user = Depends(get_current_user)
 ):
     """Get expense summary for reporting"""
-    try:
-        # Get expenses with filters
-        filter_parts = []
-        expression_attrs = {}
-        expression_values = {}
-        
-        if profile_id:
-            filter_parts.append("#profile_id = :profile_id")
-            expression_attrs["#profile_id"] = "profile_id"
-            expression_values[":profile_id"] = profile_id
-        
-        if date_from:
-            filter_parts.append("#date >= :date_from")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_from"] = date_from
-        
-        if date_to:
-            filter_parts.append("#date <= :date_to")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_to"] = date_to
-        
-        filter_expression = " AND ".join(filter_parts) if filter_parts else None
-        
-        result = db.scan_items(
-            filter_expression=filter_expression,
-            expression_attribute_names=expression_attrs,
-            expression_attribute_values=expression_values
-        )
-        
-        # Calculate summary
-        total_expenses = len(result['items'])
-        total_amount = sum(item['amount'] for item in result['items'])
-        currency = result['items'][0]['currency'] if result['items'] else 'CAD'
-        
-        by_category = {}
-        by_month = {}
-        by_tax_eligibility = {}
-        
-        for item in result['items']:
-            # By category
-            category = item['category']
-            by_category[category] = by_category.get(category, 0) + item['amount']
-            
-            # By month
-            date = datetime.fromisoformat(item['date'])
-            month_key = date.strftime('%Y-%m')
-            by_month[month_key] = by_month.get(month_key, 0) + item['amount']
-            
-            # By tax eligibility
-            eligibility = item['tax_eligibility']
-            by_tax_eligibility[eligibility] = by_tax_eligibility.get(eligibility, 0) + item['amount']
-        
-        summary = ExpenseSummary(
-            total_expenses=total_expenses,
-            total_amount=total_amount,
-            currency=currency,
-            by_category=by_category,
-            by_month=by_month,
-            by_tax_eligibility=by_tax_eligibility,
-            average_amount=total_amount / total_expenses if total_expenses > 0 else 0
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Expense summary retrieved successfully",
-            data=summary.dict()
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Get expenses with filters (profile is part of the index key)
+    filter_expression, expression_attrs, expression_values = _build_filter(
+        date_from=date_from, date_to=date_to
+    )
+    
+    # Expenses are aggregated as they stream in, across every page, without holding them all
+    items = _iter_user_expenses(
+        current_user.user_id,
+        profile_id,
+        filter_expression=filter_expression,
+        expression_attribute_names=expression_attrs,
+        expression_attribute_values=expression_values
+    )
+    
+    total_expenses = 0
+    total_cents = 0
+    currency = None
+    
+    # Accumulate integer cents; convert back to amounts once at the end
+    by_category = defaultdict(int)
+    by_month = defaultdict(int)
+    by_tax_eligibility = defaultdict(int)
+    
+    for item in items:
+        if currency is None:
+            currency = item['currency']
+        amount = expense_amount_cents(item)
+        total_expenses += 1
+        total_cents += amount
+        by_category[item['category']] += amount
+        
+        # ISO-8601 dates start with YYYY-MM
+        date = item['date']
+        month_key = date[:7] if isinstance(date, str) else date.strftime('%Y-%m')
+        by_month[month_key] += amount
+        
+        by_tax_eligibility[item['tax_eligibility']] += amount
+    
+    summary = ExpenseSummary(
+        total_expenses=total_expenses,
+        total_amount=cents_to_amount(total_cents),
+        currency=currency or 'CAD',
+        by_category={k: cents_to_amount(v) for k, v in by_category.items()},
+        by_month={k: cents_to_amount(v) for k, v in by_month.items()},
+        by_tax_eligibility={k: cents_to_amount(v) for k, v in by_tax_eligibility.items()},
+        average_amount=cents_to_amount(total_cents) / total_expenses if total_expenses > 0 else 0
+    )
+    
+    return APIResponse(
+        success=True,
+        message="Expense summary retrieved successfully",
+        data=summary.model_dump()
+    )
 
 
 @app.post("/reports/filter", response_model=APIResponse)
-async def filter_expenses_for_tax(
+def filter_expenses_for_tax(
     filter_data: ExpenseFilter,
     current_user = Depends(get_current_user)
 ):
     """Use LLM to filter and analyze expenses for tax purposes"""
-    try:
-        # Get expenses with filters
-        filter_parts = []
-        expression_attrs = {}
-        expression_values = {}
-        
-        if filter_data.profile_ids:
-            filter_parts.append("#profile_id IN (:profile_ids)")
-            expression_attrs["#profile_id"] = "profile_id"
-            expression_values[":profile_ids"] = filter_data.profile_ids
-        
-        if filter_data.categories:
-            filter_parts.append("#category IN (:categories)")
-            expression_attrs["#category"] = "category"
-            expression_values[":categories"] = filter_data.categories
-        
-        if filter_data.date_from:
-            filter_parts.append("#date >= :date_from")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_from"] = filter_data.date_from.isoformat()
-        
-        if filter_data.date_to:
-            filter_parts.append("#date <= :date_to")
-            expression_attrs["#date"] = "date"
-            expression_values[":date_to"] = filter_data.date_to.isoformat()
-        
-        filter_expression = " AND ".join(filter_parts) if filter_parts else None
-        
-        result = db.scan_items(
-            filter_expression=filter_expression,
-            expression_attribute_names=expression_attrs,
-            expression_attribute_values=expression_values
-        )
-        
-        # Use LLM to analyze expenses
-        llm_result = llm_service.filter_expenses_for_tax(
-            result['items'],
-            tax_year=datetime.now().year,
-            profile_type="business"  # This should come from the profile
-        )
-        
-        return APIResponse(
-            success=True,
-            message="Expenses filtered successfully",
-            data=llm_result
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Get expenses with filters
+    filter_expression, expression_attrs, expression_values = _build_filter(
+        profile_id=filter_data.profile_ids,
+        category=filter_data.categories,
+        date_from=filter_data.date_from.isoformat() if filter_data.date_from else None,
+        date_to=filter_data.date_to.isoformat() if filter_data.date_to else None,
+        tags=filter_data.tags
+    )
+    
+    result = _query_user_expenses(
+        current_user.user_id,
+        filter_expression=filter_expression,
+        expression_attribute_names=expression_attrs,
+        expression_attribute_values=expression_values
+    )
+    
+    # Treat the selection as personal only when every selected profile is personal
+    profile_types = {
+        profile['profile_type']
+        for profile in _get_user_profiles(current_user.user_id)
+        if not filter_data.profile_ids or profile['id'] in filter_data.profile_ids
+    }
+    profile_type = "personal" if profile_types == {"personal"} else "business"
+    
+    # Use LLM to analyze expenses
+    llm_result = llm_service.filter_expenses_for_tax(
+        result['items'],
+        tax_year=datetime.now().year,
+        profile_type=profile_type
+    )
+    
+    return APIResponse(
+        success=True,
+        message="Expenses filtered successfully",
+        data=llm_result
+    )
 
 
 # Health check endpoint
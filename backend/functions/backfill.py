@@ -0,0 +1,118 @@
+import orjson
+import os
+from typing import Tuple
+from datetime import datetime
+
+# Import shared modules
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.database import db, DynamoKeys
+
+# Expenses written before GSI_Unverified existed carry no verification_status, so the
+# analyzer never sees them. Unverified ones get the status; verified ones stay out of the index.
+LEGACY_UNVERIFIED_FILTER = (
+    "begins_with(#sk, :expense_prefix) AND attribute_not_exists(#verification_status) "
+    "AND (attribute_not_exists(#is_verified) OR #is_verified = :false)"
+)
+LEGACY_UNVERIFIED_NAMES = {
+    '#pk': 'pk',
+    '#sk': 'sk',
+    '#verification_status': 'verification_status',
+    '#is_verified': 'is_verified'
+}
+LEGACY_UNVERIFIED_VALUES = {':expense_prefix': 'EXPENSE#', ':false': False}
+
+# Expenses written before GSI1 existed have no gsi1pk/gsi1sk and are missing from
+# profile-scoped lists and summaries
+LEGACY_INDEX_FILTER = "begins_with(#sk, :expense_prefix) AND attribute_not_exists(#gsi1pk)"
+LEGACY_INDEX_NAMES = {
+    '#pk': 'pk',
+    '#sk': 'sk',
+    '#gsi1pk': 'gsi1pk',
+    '#profile_id': 'profile_id',
+    '#date': 'date'
+}
+LEGACY_INDEX_VALUES = {':expense_prefix': 'EXPENSE#'}
+
+
+def handler(event, context):
+    """One-off migration of items written before the current index layout; safe to re-run"""
+    try:
+        indexed_count, index_errors = backfill_expense_index_keys()
+        unverified_count, unverified_errors = backfill_verification_status()
+        error_count = index_errors + unverified_errors
+        
+        print(f"Backfill completed. Indexed: {indexed_count}, Unverified: {unverified_count}, Errors: {error_count}")
+        
+        return {
+            'statusCode': 200 if not error_count else 500,
+            'body': orjson.dumps({
+                'success': not error_count,
+                'indexed_count': indexed_count,
+                'unverified_count': unverified_count,
+                'error_count': error_count
+            }).decode()
+        }
+    
+    except Exception as e:
+        print(f"Error in backfill: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': orjson.dumps({
+                'success': False,
+                'error': str(e)
+            }).decode()
+        }
+
+
+def backfill_expense_index_keys() -> Tuple[int, int]:
+    """Give legacy expenses their GSI1 (user, profile#date) keys; returns (updated, errors)"""
+    items = db.iter_scan(
+        filter_expression=LEGACY_INDEX_FILTER,
+        expression_attribute_names=LEGACY_INDEX_NAMES,
+        expression_attribute_values=LEGACY_INDEX_VALUES,
+        projection_expression='#pk, #sk, #profile_id, #date'
+    )
+    
+    updates = []
+    for item in items:
+        date = item['date']
+        if isinstance(date, datetime):
+            date = date.isoformat()
+        # Expenses live in their user's partition, so gsi1pk is the item's own pk
+        updates.append((item['pk'], item['sk'], {
+            'gsi1pk': item['pk'],
+            'gsi1sk': DynamoKeys.expense_by_profile_sk(item['profile_id'], date)
+        }))
+    
+    # The condition keeps an expense deleted since the scan from coming back as a stub
+    results = db.update_items(updates, condition_expression='attribute_exists(pk)')
+    for error in results:
+        if error is not None:
+            print(f"Error backfilling index keys: {str(error)}")
+    
+    error_count = sum(error is not None for error in results)
+    return len(results) - error_count, error_count
+
+
+def backfill_verification_status() -> Tuple[int, int]:
+    """Put legacy unverified expenses into GSI_Unverified; returns (updated, errors)"""
+    items = db.iter_scan(
+        filter_expression=LEGACY_UNVERIFIED_FILTER,
+        expression_attribute_names=LEGACY_UNVERIFIED_NAMES,
+        expression_attribute_values=LEGACY_UNVERIFIED_VALUES,
+        projection_expression='#pk, #sk'
+    )
+    
+    # The condition keeps an expense deleted since the scan from coming back as a stub
+    results = db.update_items([
+        (item['pk'], item['sk'], {'verification_status': 'UNVERIFIED'})
+        for item in items
+    ], condition_expression='attribute_exists(pk)')
+    for error in results:
+        if error is not None:
+            print(f"Error backfilling verification_status: {str(error)}")
+    
+    error_count = sum(error is not None for error in results)
+    return len(results) - error_count, error_count
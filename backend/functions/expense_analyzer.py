@@ -1,7 +1,11 @@
-import json
+import orjson
 import os
+import time
+import asyncio
+import hashlib
 import boto3
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 # Import shared modules
@@ -10,7 +14,40 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from shared.config import settings
 from shared.database import db, DynamoKeys
-from shared.ai_services import llm_service
+from shared.ai_services import llm_service, CircuitOpenError
+from shared.models import cents_to_amount, expense_amount_cents
+
+# Sparse index over expenses still awaiting LLM verification; verification_status is
+# removed once an expense is analyzed, which takes it out of the index
+UNVERIFIED_INDEX = 'GSI_Unverified'
+UNVERIFIED_STATUS = 'UNVERIFIED'
+
+# Only the attributes the tax eligibility prompt needs
+ANALYSIS_FIELDS = ('pk', 'sk', 'id', 'amount', 'amount_cents', 'currency',
+                   'description', 'category', 'date', 'notes', 'created_at')
+ANALYSIS_PROJECTION = ', '.join(f'#{field}' for field in ANALYSIS_FIELDS)
+ANALYSIS_PROJECTION_NAMES = {f'#{field}': field for field in ANALYSIS_FIELDS}
+
+# Expenses per tax eligibility prompt; larger batches start to hurt accuracy
+LLM_BATCH_SIZE = 12
+
+# Tax analyses are cached by expense content for 90 days; recurring charges hit it
+TAX_ANALYSIS_CACHE_TTL = 90 * 86400
+
+# Batches in flight at once; keeps us under the Gemini requests-per-minute quota
+LLM_CONCURRENCY = 4
+
+# Summary report scans in parallel and skips large attributes like llm_analysis
+SUMMARY_SCAN_SEGMENTS = 8
+HIGH_AMOUNT_CENTS = 1000 * 100
+SUMMARY_FIELDS = ('id', 'amount', 'amount_cents', 'category', 'tax_eligibility',
+                  'created_at', 'description', 'is_verified')
+SUMMARY_PROJECTION = ', '.join(f'#{field}' for field in SUMMARY_FIELDS)
+SUMMARY_PROJECTION_NAMES = {f'#{field}': field for field in SUMMARY_FIELDS}
+SUMMARY_NAMES = {**SUMMARY_PROJECTION_NAMES, '#sk': 'sk'}
+
+# Only expense items count; profiles, receipts and cache entries are dropped server-side
+SUMMARY_FILTER = "begins_with(#sk, :expense_prefix) AND #created_at BETWEEN :start_date AND :end_date"
 
 
 def handler(event, context):
@@ -18,97 +55,250 @@ def handler(event, context):
     try:
         print("Starting batch expense analysis")
         
-        # Get all unverified expenses from the last 30 days
+        # Query unverified expenses from the last 30 days, one page at a time
         thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
         
-        result = db.scan_items(
-            filter_expression="#is_verified = :is_verified AND #created_at >= :date_from",
-            expression_attribute_names={
-                "#is_verified": "is_verified",
-                "#created_at": "created_at"
-            },
-            expression_attribute_values={
-                ":is_verified": False,
-                ":date_from": thirty_days_ago
-            }
-        )
-        
-        expenses = result['items']
-        print(f"Found {len(expenses)} unverified expenses to analyze")
-        
         processed_count = 0
         error_count = 0
+        deferred_count = 0
+        start_key = None
         
-        for expense in expenses:
-            try:
-                # Analyze expense for tax eligibility
-                analysis_result = llm_service.analyze_expense_tax_eligibility(expense)
-                
-                # Update expense with analysis
-                updates = {
-                    'tax_eligibility': analysis_result['tax_eligibility'],
-                    'is_verified': True,
-                    'llm_analysis': analysis_result,
-                    'analyzed_at': datetime.utcnow().isoformat()
-                }
-                
-                # Update category if suggested
-                if analysis_result.get('category_suggestion'):
-                    updates['category'] = analysis_result['category_suggestion']
-                
-                db.update_item(
-                    pk=expense['pk'],
-                    sk=expense['sk'],
-                    updates=updates
-                )
-                
-                processed_count += 1
-                print(f"Processed expense {expense['id']}")
-                
-            except Exception as e:
-                error_count += 1
-                print(f"Error processing expense {expense.get('id', 'unknown')}: {str(e)}")
-                
-                # Update expense with error
-                try:
-                    db.update_item(
-                        pk=expense['pk'],
-                        sk=expense['sk'],
-                        updates={
-                            'is_verified': False,
-                            'llm_analysis': {
-                                'error': str(e),
-                                'processed_at': datetime.utcnow().isoformat()
-                            }
-                        }
-                    )
-                except Exception as update_error:
-                    print(f"Error updating expense with error: {str(update_error)}")
+        while True:
+            result = db.query_gsi(
+                gsi_name=UNVERIFIED_INDEX,
+                gsi_pk=UNVERIFIED_STATUS,
+                gsi_pk_attr='verification_status',
+                gsi_sk_attr='created_at',
+                gsi_sk_condition='>=',
+                gsi_sk_value=thirty_days_ago,
+                start_key=start_key,
+                projection_expression=ANALYSIS_PROJECTION,
+                expression_attribute_names=ANALYSIS_PROJECTION_NAMES
+            )
+            
+            expenses = result['items']
+            print(f"Found {len(expenses)} unverified expenses to analyze")
+            
+            page_processed, page_errors, page_deferred = asyncio.run(analyze_expenses(expenses))
+            processed_count += page_processed
+            error_count += page_errors
+            deferred_count += page_deferred
+            
+            # The LLM is failing; leave the rest unverified for the next run
+            if page_deferred:
+                print("LLM circuit open, deferring remaining expenses")
+                break
+            
+            start_key = result['last_evaluated_key']
+            if not start_key:
+                break
         
         # Generate summary report
         summary = generate_summary_report()
         
-        print(f"Batch analysis completed. Processed: {processed_count}, Errors: {error_count}")
+        print(f"Batch analysis completed. Processed: {processed_count}, Errors: {error_count}, Deferred: {deferred_count}")
         
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'success': True,
                 'processed_count': processed_count,
                 'error_count': error_count,
+                'deferred_count': deferred_count,
                 'summary': summary
-            })
+            }).decode()
         }
         
     except Exception as e:
         print(f"Error in batch analysis: {str(e)}")
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': orjson.dumps({
+                'success': False,
+                'error': str(e)
+            }).decode()
+        }
+
+
+def stream_handler(event, context):
+    """Analyze expenses as soon as they are written, fed by the table's DynamoDB stream
+    
+    The event source filter only passes inserts of unverified expenses. Anything deferred or
+    failed here stays unverified and is retried by the hourly handler.
+    """
+    try:
+        expenses = []
+        for record in event.get('Records', []):
+            item = db.deserialize_stream_image(record['dynamodb']['NewImage'])
+            expenses.append({field: item[field] for field in ANALYSIS_FIELDS if field in item})
+        
+        print(f"Analyzing {len(expenses)} new expenses from the stream")
+        processed_count, error_count, deferred_count = asyncio.run(analyze_expenses(expenses))
+        
+        print(f"Stream analysis completed. Processed: {processed_count}, Errors: {error_count}, Deferred: {deferred_count}")
+        
+        return {
+            'statusCode': 200,
+            'body': orjson.dumps({
+                'success': True,
+                'processed_count': processed_count,
+                'error_count': error_count,
+                'deferred_count': deferred_count
+            }).decode()
+        }
+        
+    except Exception as e:
+        # Returning instead of raising keeps a bad record from blocking the shard
+        print(f"Error in stream analysis: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': orjson.dumps({
                 'success': False,
                 'error': str(e)
-            })
+            }).decode()
+        }
+
+
+async def analyze_expenses(expenses: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    """Analyze expenses in LLM-sized batches, running a bounded number of batches at once"""
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    
+    async def bounded(batch: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+        async with semaphore:
+            if llm_service.breaker.is_open:
+                return 0, 0, len(batch)
+            return await asyncio.to_thread(process_expense_batch, batch)
+    
+    # Several expenses share one prompt to amortize the instructions and round trip
+    results = await asyncio.gather(*[
+        bounded(expenses[offset:offset + LLM_BATCH_SIZE])
+        for offset in range(0, len(expenses), LLM_BATCH_SIZE)
+    ])
+    
+    return tuple(sum(counts) for counts in zip(*results)) if results else (0, 0, 0)
+
+
+def process_expense_batch(batch: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    """Run one batched tax eligibility analysis and store the results.
+    
+    Returns (processed, errors, deferred); a batch is deferred untouched when the
+    LLM circuit breaker is open.
+    """
+    processed_count = 0
+    
+    cache_keys = []
+    for expense in batch:
+        expense['amount'] = cents_to_amount(expense_amount_cents(expense))
+        cache_keys.append(tax_analysis_cache_key(expense))
+    
+    # Reuse analyses of identical expenses; only the misses go to the LLM
+    try:
+        cached = {
+            item['pk']: item['analysis']
+            for item in db.batch_get_items([{'pk': key, 'sk': key} for key in set(cache_keys)])
         }
+    except Exception as e:
+        print(f"Error reading tax analysis cache: {str(e)}")
+        cached = {}
+    
+    miss_keys = [key for key in cache_keys if key not in cached]
+    misses = [expense for expense, key in zip(batch, cache_keys) if key not in cached]
+    
+    try:
+        miss_results = llm_service.analyze_expenses_batch(misses) if misses else []
+    except CircuitOpenError:
+        return 0, 0, len(batch)
+    except Exception as e:
+        miss_results = [e] * len(misses)
+    
+    fresh = {}
+    for key, analysis_result in zip(miss_keys, miss_results):
+        # Don't cache fallbacks from failed or unparseable LLM responses
+        if not isinstance(analysis_result, Exception) and analysis_result.get('confidence'):
+            fresh[key] = analysis_result
+    
+    if fresh:
+        expires_at = int(time.time()) + TAX_ANALYSIS_CACHE_TTL
+        try:
+            db.batch_write_items([
+                {'pk': key, 'sk': key, 'analysis': analysis, 'ttl': expires_at}
+                for key, analysis in fresh.items()
+            ])
+        except Exception as e:
+            print(f"Error writing tax analysis cache: {str(e)}")
+    
+    miss_iter = iter(miss_results)
+    analysis_results = [
+        cached[key] if key in cached else next(miss_iter)
+        for key in cache_keys
+    ]
+    
+    # One timestamp for the whole batch
+    now_iso = datetime.utcnow().isoformat()
+    updates = []
+    failures = []
+    for expense, analysis_result in zip(batch, analysis_results):
+        if isinstance(analysis_result, Exception):
+            failures.append((expense, analysis_result))
+            continue
+        
+        # Update expense with analysis
+        fields = {
+            'tax_eligibility': analysis_result['tax_eligibility'],
+            'is_verified': True,
+            'llm_analysis': analysis_result,
+            'analyzed_at': now_iso
+        }
+        
+        # Update category if suggested
+        if analysis_result.get('category_suggestion'):
+            fields['category'] = analysis_result['category_suggestion']
+        
+        updates.append((expense, fields))
+    
+    # BatchWriteItem can only replace whole items, so the partial updates are pipelined instead
+    results = db.update_items(
+        [(e['pk'], e['sk'], fields) for e, fields in updates],
+        remove=('verification_status',)
+    )
+    for (expense, _), error in zip(updates, results):
+        if error is None:
+            processed_count += 1
+            print(f"Processed expense {expense['id']}")
+        else:
+            failures.append((expense, error))
+    
+    for expense, error in failures:
+        print(f"Error processing expense {expense.get('id', 'unknown')}: {str(error)}")
+    error_count = len(failures)
+    
+    # Update failed expenses with the error
+    error_results = db.update_items([
+        (expense['pk'], expense['sk'], {
+            'is_verified': False,
+            'llm_analysis': {
+                'error': str(error),
+                'processed_at': now_iso
+            }
+        })
+        for expense, error in failures
+    ])
+    for update_error in error_results:
+        if update_error is not None:
+            print(f"Error updating expense with error: {str(update_error)}")
+    
+    return processed_count, error_count, 0
+
+
+def tax_analysis_cache_key(expense: Dict[str, Any]) -> str:
+    """Cache key for an expense's tax analysis, derived from the fields the LLM judges it on"""
+    content = "|".join([
+        (expense.get('description') or '').strip().lower(),
+        str(expense_amount_cents(expense)),
+        expense.get('currency') or '',
+        expense.get('category') or ''
+    ])
+    return DynamoKeys.tax_analysis_cache_key(hashlib.sha256(content.encode()).hexdigest())
 
 
 def generate_summary_report() -> Dict[str, Any]:
@@ -119,68 +309,69 @@ def generate_summary_report() -> Dict[str, Any]:
         year_start = f"{current_year}-01-01T00:00:00"
         year_end = f"{current_year}-12-31T23:59:59"
         
-        result = db.scan_items(
-            filter_expression="#created_at BETWEEN :start_date AND :end_date",
-            expression_attribute_names={"#created_at": "created_at"},
+        expenses = db.parallel_scan(
+            total_segments=SUMMARY_SCAN_SEGMENTS,
+            filter_expression=SUMMARY_FILTER,
+            projection_expression=SUMMARY_PROJECTION,
+            expression_attribute_names=SUMMARY_NAMES,
             expression_attribute_values={
+                ":expense_prefix": DynamoKeys.EXPENSE_PREFIX,
                 ":start_date": year_start,
                 ":end_date": year_end
             }
         )
         
-        expenses = result['items']
-        
-        # Calculate totals
-        total_expenses = len(expenses)
-        total_amount = sum(expense.get('amount', 0) for expense in expenses)
-        
-        # By category
-        by_category = {}
-        for expense in expenses:
-            category = expense.get('category', 'OTHER')
-            by_category[category] = by_category.get(category, 0) + expense.get('amount', 0)
-        
-        # By tax eligibility
-        by_eligibility = {}
-        for expense in expenses:
-            eligibility = expense.get('tax_eligibility', 'REQUIRES_REVIEW')
-            by_eligibility[eligibility] = by_eligibility.get(eligibility, 0) + expense.get('amount', 0)
-        
-        # By month
-        by_month = {}
-        for expense in expenses:
-            try:
-                date = datetime.fromisoformat(expense.get('created_at', ''))
-                month_key = date.strftime('%Y-%m')
-                by_month[month_key] = by_month.get(month_key, 0) + expense.get('amount', 0)
-            except:
-                pass
-        
-        # Flag potential issues
+        # Aggregate everything in a single pass, accumulating integer cents
+        total_cents = 0
+        by_category = defaultdict(int)
+        by_eligibility = defaultdict(int)
+        by_month = defaultdict(int)
         flagged_expenses = []
+        
         for expense in expenses:
+            get = expense.get
+            cents = expense_amount_cents(expense)
+            eligibility = get('tax_eligibility', 'REQUIRES_REVIEW')
+            
+            total_cents += cents
+            by_category[get('category', 'OTHER')] += cents
+            by_eligibility[eligibility] += cents
+            
+            # ISO-8601 timestamps start with YYYY-MM
+            created_at = get('created_at')
+            if created_at:
+                month_key = created_at[:7] if isinstance(created_at, str) else created_at.strftime('%Y-%m')
+                by_month[month_key] += cents
+            
+            # Flag potential issues
             issues = []
             
             # Check for high amounts
-            if expense.get('amount', 0) > 1000:
+            if cents > HIGH_AMOUNT_CENTS:
                 issues.append("High amount - may need documentation")
             
             # Check for personal expenses
-            if expense.get('tax_eligibility') == 'PERSONAL':
+            if eligibility == 'PERSONAL':
                 issues.append("Marked as personal expense")
             
             # Check for unverified expenses
-            if not expense.get('is_verified', False):
+            if not get('is_verified', False):
                 issues.append("Not yet verified by AI")
             
             if issues:
                 flagged_expenses.append({
-                    'id': expense.get('id'),
-                    'amount': expense.get('amount'),
-                    'description': expense.get('description'),
+                    'id': get('id'),
+                    'amount': cents_to_amount(cents),
+                    'description': get('description'),
                     'issues': issues
                 })
         
+        total_expenses = len(expenses)
+        total_amount = cents_to_amount(total_cents)
+        by_category = {k: cents_to_amount(v) for k, v in by_category.items()}
+        by_eligibility = {k: cents_to_amount(v) for k, v in by_eligibility.items()}
+        by_month = {k: cents_to_amount(v) for k, v in by_month.items()}
+        
         return {
             'year': current_year,
             'total_expenses': total_expenses,
@@ -1,70 +1,122 @@
-import json
+import orjson
 import os
-import boto3
-from typing import Dict, Any
+import asyncio
+from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
+from typing import Dict, List, Any, Tuple
 from datetime import datetime
 
 # Import shared modules
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from shared.config import settings
+from shared import aws
 from shared.database import db, DynamoKeys
-from shared.ai_services import rekognition_service, llm_service, location_service
+from shared.ai_services import rekognition_service, llm_service, location_service, read_exif, slim_exif
+
+# Created once per container and reused across warm invocations
+_s3 = aws.client('s3')
+
+# A JPEG APP1 (EXIF) segment is at most 64 KB
+EXIF_RANGE = 'bytes=0-65535'
+
+# Guards against duplicate S3 events overwriting a processed receipt
+NOT_PROCESSED_CONDITION = "attribute_not_exists(#is_processed) OR #is_processed = :not_processed"
+NOT_PROCESSED_NAMES = {'#is_processed': 'is_processed'}
+NOT_PROCESSED_VALUES = {':not_processed': False}
+
+# Receipts in flight at once; one receipt's OCR overlaps another's Gemini call
+RECORD_CONCURRENCY = 8
+
+# One loop per container, reused across warm invocations. The Gemini async client keeps a
+# grpc.aio channel bound to the loop it was created on, so a fresh asyncio.run() loop per
+# invocation would break every call after the first.
+_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(_loop)
 
 
 def handler(event, context):
     """Process uploaded images for OCR and analysis"""
+    results = _loop.run_until_complete(process_records(event.get('Records', [])))
+    
+    if len(results) == 1:
+        status_code, payload = results[0]
+    else:
+        status_code = 200 if all(code == 200 for code, _ in results) else 500
+        payload = {
+            'success': status_code == 200,
+            'results': [result for _, result in results]
+        }
+    
+    return {
+        'statusCode': status_code,
+        'body': orjson.dumps(payload).decode()
+    }
+
+
+async def process_records(records: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any]]]:
+    """Run every S3 record through OCR, analysis and storage with overlapping stages"""
+    semaphore = asyncio.Semaphore(RECORD_CONCURRENCY)
+    
+    async def bounded(record: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        async with semaphore:
+            return await process_record(record)
+    
+    return await asyncio.gather(*[bounded(record) for record in records])
+
+
+async def process_record(record: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    """Process one uploaded image; blocking AWS calls run in threads so other records keep moving"""
     try:
         # Parse S3 event
-        s3_event = event['Records'][0]['s3']
+        s3_event = record['s3']
         bucket_name = s3_event['bucket']['name']
-        object_key = s3_event['object']['key']
+        object_key = unquote_plus(s3_event['object']['key'])
         
         print(f"Processing image: {object_key} from bucket: {bucket_name}")
         
-        # Download image from S3
-        s3_client = boto3.client('s3', region_name=settings.aws_region)
-        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        image_bytes = response['Body'].read()
-        
         # Extract user_id and receipt_id from the key
-        # Expected format: uploads/{user_id}/{date}/{filename}
+        # Expected format: uploads/{user_id}/{yyyy}/{mm}/{dd}/{receipt_id}/{filename}
         key_parts = object_key.split('/')
-        if len(key_parts) < 4:
+        if len(key_parts) < 7:
             raise Exception(f"Invalid object key format: {object_key}")
         
         user_id = key_parts[1]
-        filename = key_parts[-1]
         
-        # Find receipt record by file_key
-        result = db.scan_items(
-            filter_expression="#file_key = :file_key",
-            expression_attribute_names={"#file_key": "file_key"},
-            expression_attribute_values={":file_key": object_key}
+        # Look up the receipt record directly by its key; concurrent records share one BatchGetItem
+        receipt = await asyncio.to_thread(
+            db.get_item_batched,
+            DynamoKeys.user_key(user_id),
+            DynamoKeys.receipt_key(user_id, key_parts[-2])
         )
         
-        if not result['items']:
+        if not receipt:
             raise Exception(f"No receipt record found for file_key: {object_key}")
         
-        receipt = result['items'][0]
         receipt_id = receipt['id']
         
-        # Extract EXIF data
-        import exifread
-        from PIL import Image
-        import io
+        # S3 may deliver the same event more than once
+        if receipt.get('is_processed'):
+            print(f"Receipt {receipt_id} already processed, skipping")
+            return 200, {
+                'success': True,
+                'receipt_id': receipt_id,
+                'skipped': True
+            }
         
-        image = Image.open(io.BytesIO(image_bytes))
-        exif_data = {}
-        if hasattr(image, '_getexif') and image._getexif():
-            exif_data = exifread.process_file(io.BytesIO(image_bytes))
+        # OCR and the EXIF read are independent, so they run side by side
+        ocr_result, exif_data = await asyncio.gather(
+            # Rekognition reads the image from S3 itself
+            asyncio.to_thread(
+                rekognition_service.detect_text,
+                s3_object={'Bucket': bucket_name, 'Name': object_key}
+            ),
+            asyncio.to_thread(read_object_exif, bucket_name, object_key)
+        )
         
         # Extract location from EXIF
         location = location_service.extract_location_from_exif(exif_data)
         
-        # Perform OCR
-        ocr_result = rekognition_service.detect_text(image_bytes)
         if not ocr_result['success']:
             raise Exception(f"OCR failed: {ocr_result.get('error', 'Unknown error')}")
         
@@ -72,43 +124,46 @@ def handler(event, context):
         ocr_text = ' '.join([block['text'] for block in ocr_result['text_blocks']])
         
         # Analyze with LLM
-        analysis = llm_service.analyze_receipt(ocr_text, {
+        analysis = await llm_service.analyze_receipt_async(ocr_text, {
             'file_size': receipt['file_size'],
             'content_type': receipt['content_type'],
-            'exif_data': exif_data
+            'exif_data': slim_exif(exif_data)
         })
         
-        # Update receipt with analysis
-        db.update_item(
-            pk=DynamoKeys.user_key(user_id),
-            sk=DynamoKeys.receipt_key(user_id, receipt_id),
-            updates={
-                'analysis': analysis.dict(),
-                'is_processed': True,
-                'processed_at': datetime.utcnow().isoformat()
-            }
-        )
+        # Update receipt with analysis (and location, if found) in one write
+        analysis_data = analysis.model_dump()
+        location_data = location.model_dump() if location else None
         
-        # If location was found, update the receipt
-        if location:
-            db.update_item(
+        updates = {
+            'analysis': analysis_data,
+            'is_processed': True,
+            'processed_at': datetime.utcnow().isoformat()
+        }
+        if location_data:
+            updates['location'] = location_data
+        
+        try:
+            await asyncio.to_thread(
+                db.update_item,
                 pk=DynamoKeys.user_key(user_id),
                 sk=DynamoKeys.receipt_key(user_id, receipt_id),
-                updates={
-                    'location': location.dict()
-                }
+                updates=updates,
+                condition_expression=NOT_PROCESSED_CONDITION,
+                condition_names=NOT_PROCESSED_NAMES,
+                condition_values=NOT_PROCESSED_VALUES
             )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            print(f"Receipt {receipt_id} was processed concurrently, skipping")
         
         print(f"Successfully processed receipt {receipt_id}")
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'success': True,
-                'receipt_id': receipt_id,
-                'analysis': analysis.dict(),
-                'location': location.dict() if location else None
-            })
+        return 200, {
+            'success': True,
+            'receipt_id': receipt_id,
+            'analysis': analysis_data,
+            'location': location_data
         }
         
     except Exception as e:
@@ -117,7 +172,8 @@ def handler(event, context):
         # Update receipt with error
         try:
             if 'receipt_id' in locals() and 'user_id' in locals():
-                db.update_item(
+                await asyncio.to_thread(
+                    db.update_item,
                     pk=DynamoKeys.user_key(user_id),
                     sk=DynamoKeys.receipt_key(user_id, receipt_id),
                     updates={
@@ -129,10 +185,18 @@ def handler(event, context):
         except Exception as update_error:
             print(f"Error updating receipt with error: {str(update_error)}")
         
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'success': False,
-                'error': str(e)
-            })
-        } 
\ No newline at end of file
+        return 500, {
+            'success': False,
+            'error': str(e)
+        }
+
+
+def read_object_exif(bucket_name: str, object_key: str) -> Dict[str, Any]:
+    """Read EXIF tags from the head of an S3 object, or nothing if it has none"""
+    # EXIF lives in the first APP1 segment, so only the head of the object is fetched
+    try:
+        response = _s3.get_object(Bucket=bucket_name, Key=object_key, Range=EXIF_RANGE)
+        return read_exif(response['Body'].read())
+    except Exception as e:
+        print(f"Could not read EXIF from {object_key}: {e}")
+        return {}
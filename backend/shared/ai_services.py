@@ -1,23 +1,230 @@
-import boto3
-import json
+import io
+import os
+import re
+import logging
+import exifread
+import orjson
 import base64
-from typing import Dict, List, Optional, Any
-from datetime import datetime
+import asyncio
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+from decimal import Decimal
 import google.generativeai as genai
+from cachetools import TTLCache
 from .config import settings
+from . import aws
 from .models import ReceiptAnalysis, Currency, Location
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# EXIF tags worth sending to the LLM; the rest is camera noise that only costs tokens
+EXIF_WHITELIST = (
+    'EXIF DateTimeOriginal',
+    'Image Make',
+    'Image Model',
+    'Image Orientation',
+    'GPS GPSLatitude',
+    'GPS GPSLongitude',
+)
+
+
+def read_exif(image_bytes: bytes) -> Dict[str, Any]:
+    """Extract EXIF tags from raw image bytes in one pass, skipping the GPS tags after the longitude"""
+    # exifread matches stop_tag against the bare tag name (no 'GPS ' prefix); it ends the walk
+    # of the IFD holding that tag, so the remaining GPS tags are never decoded
+    return exifread.process_file(
+        io.BytesIO(image_bytes),
+        details=False,
+        stop_tag='GPSLongitude'
+    )
+
+
+def slim_exif(exif_data: Dict[str, Any]) -> Dict[str, str]:
+    """Reduce exifread tags to the whitelisted fields as plain strings"""
+    return {key: str(exif_data[key]) for key in EXIF_WHITELIST if key in exif_data}
+
+
+# Regexes used on every receipt/response, compiled once at import
+# One alternation finds every currency amount in a single walk of the text;
+# the group name says which currency matched
+_MONEY_RE = re.compile(
+    r'\$(?P<USD>\d+\.?\d*)'
+    r'|CAD\s*(?P<CAD_PREFIX>\d+\.?\d*)'
+    r'|(?P<CAD_SUFFIX>\d+\.?\d*)\s*CAD'
+    r'|€(?P<EUR>\d+\.?\d*)'
+    r'|£(?P<GBP>\d+\.?\d*)',
+    re.IGNORECASE
+)
+_MONEY_GROUP_CURRENCY = {
+    'USD': 'USD',
+    'CAD_PREFIX': 'CAD',
+    'CAD_SUFFIX': 'CAD',
+    'EUR': 'EUR',
+    'GBP': 'GBP',
+}
+# When several currencies appear, the first one in this order wins
+_CURRENCY_PRIORITY = ('USD', 'CAD', 'EUR', 'GBP')
+
+_DATE_RES = [
+    re.compile(r'(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})'),
+    re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'),
+    re.compile(r'(\w+)\s+(\d{1,2}),?\s+(\d{4})'),
+]
+
+# Coordinates are searched for before addresses: \w also matches digits, so the address
+# pattern alone would read "Ottawa, ON, 45.42, 75.69" as the address Ottawa / ON / 45
+_COORDINATES_RE = re.compile(r'(?P<lat>-?\d+\.\d+),\s*(?P<lon>-?\d+\.\d+)')
+_ADDRESS_RE = re.compile(r'(?P<city>\w+),\s*(?P<province>\w+),\s*(?P<country>\w+)')
+
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+# Identical receipts (same template, re-uploads) reuse the analysis instead of calling Gemini again
+RECEIPT_CACHE_SIZE = 2048
+RECEIPT_CACHE_TTL = 86400
+
+# Confidence reported by _fallback_analysis; results at or below it are never cached
+FALLBACK_CONFIDENCE = 0.1
+
+# Ask Gemini for bare JSON so responses can be decoded directly, and cap the output size
+LLM_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "max_output_tokens": settings.max_tokens,
+}
+
+
+def _json_default(value: Any) -> Any:
+    """Encode DynamoDB Decimals as numbers, sets as lists and anything else orjson can't handle as text"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return str(value)
+
+
+def _prompt_json(value: Any) -> str:
+    """Compact JSON for prompts; indentation only costs input tokens"""
+    return orjson.dumps(value, default=_json_default).decode()
+
+
+def _load_json(response: str, pattern: re.Pattern) -> Any:
+    """Decode a JSON-mode response, falling back to the first match of pattern for wrapped output"""
+    try:
+        return orjson.loads(response)
+    except orjson.JSONDecodeError:
+        json_match = pattern.search(response)
+        if not json_match:
+            raise
+        return orjson.loads(json_match.group())
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency that has been failing"""
+
+
+class CircuitBreaker:
+    """Stop calling a failing dependency after fail_max consecutive errors.
+    
+    Once open, calls fail fast until reset_timeout seconds have passed. The circuit is
+    then half-open: a single call is let through as a trial while every other caller
+    keeps getting CircuitOpenError. The trial closes the circuit if it succeeds and
+    reopens it for another reset_timeout if it fails.
+    """
+    
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self) -> bool:
+        """True while calls would be rejected; a half-open circuit with no trial running is not"""
+        with self._lock:
+            return self._rejects(time.monotonic())
+    
+    def _rejects(self, now: float) -> bool:
+        return (self._opened_at is not None
+                and (now - self._opened_at < self.reset_timeout or self._trial_in_flight))
+    
+    def _admit(self):
+        """Let a call through, or raise CircuitOpenError; claims the trial when half-open"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._rejects(time.monotonic()):
+                raise CircuitOpenError("Circuit open; skipping call")
+            self._trial_in_flight = True
+    
+    def call(self, func, *args, **kwargs):
+        self._admit()
+        
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        except BaseException:
+            self._release_trial()
+            raise
+        
+        self._record_success()
+        return result
+    
+    async def call_async(self, func, *args, **kwargs):
+        self._admit()
+        
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        except BaseException:
+            # Cancelled trials say nothing about the dependency; let the next caller probe
+            self._release_trial()
+            raise
+        
+        self._record_success()
+        return result
+    
+    def _record_failure(self):
+        with self._lock:
+            self._trial_in_flight = False
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+    
+    def _record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+    
+    def _release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
 
 class RekognitionService:
     def __init__(self):
-        self.client = boto3.client('rekognition', region_name=settings.aws_region)
+        self.client = aws.client('rekognition')
     
-    def detect_text(self, image_bytes: bytes) -> Dict[str, Any]:
-        """Detect text in an image using AWS Rekognition"""
+    def detect_text(self, image_bytes: Optional[bytes] = None,
+                    s3_object: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Detect text in an image using AWS Rekognition.
+        
+        Pass s3_object ({'Bucket': ..., 'Name': ...}) to let Rekognition read the
+        image from S3 directly instead of sending the bytes.
+        """
         try:
-            response = self.client.detect_text(
-                Image={'Bytes': image_bytes}
-            )
+            image = {'S3Object': s3_object} if s3_object else {'Bytes': image_bytes}
+            response = self.client.detect_text(Image=image)
             
             # Extract all detected text
             text_blocks = []
@@ -41,6 +248,18 @@ class RekognitionService:
                 'text_blocks': []
             }
     
+    async def detect_text_batch(self, images: List[bytes],
+                                max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Detect text in many images with overlapping Rekognition requests"""
+        semaphore = asyncio.Semaphore(max_concurrency or settings.ocr_concurrency)
+        
+        async def detect_one(image_bytes: bytes) -> Dict[str, Any]:
+            async with semaphore:
+                # The botocore client is thread-safe and pools its connections
+                return await asyncio.to_thread(self.detect_text, image_bytes)
+        
+        return await asyncio.gather(*[detect_one(image_bytes) for image_bytes in images])
+    
     def analyze_document(self, image_bytes: bytes) -> Dict[str, Any]:
         """Analyze document structure using AWS Textract-like features"""
         try:
@@ -84,35 +303,22 @@ class RekognitionService:
         }
         
         # Look for currency symbols and amounts
-        import re
-        
-        # Currency patterns
-        currency_patterns = {
-            r'\$(\d+\.?\d*)': 'USD',
-            r'CAD\s*(\d+\.?\d*)': 'CAD',
-            r'(\d+\.?\d*)\s*CAD': 'CAD',
-            r'€(\d+\.?\d*)': 'EUR',
-            r'£(\d+\.?\d*)': 'GBP'
-        }
+        amounts_by_currency = {}
+        for match in _MONEY_RE.finditer(full_text):
+            currency = _MONEY_GROUP_CURRENCY[match.lastgroup]
+            amounts_by_currency.setdefault(currency, []).append(float(match.group(match.lastgroup)))
         
-        for pattern, currency in currency_patterns.items():
-            matches = re.findall(pattern, full_text, re.IGNORECASE)
-            if matches:
+        for currency in _CURRENCY_PRIORITY:
+            amounts = amounts_by_currency.get(currency)
+            if amounts:
                 # Try to find the largest amount as total
-                amounts = [float(match) for match in matches]
                 structured_data['total_amount'] = max(amounts)
                 structured_data['currency'] = currency
                 break
         
         # Look for date patterns
-        date_patterns = [
-            r'(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})',
-            r'(\d{4})-(\d{1,2})-(\d{1,2})',
-            r'(\w+)\s+(\d{1,2}),?\s+(\d{4})'
-        ]
-        
-        for pattern in date_patterns:
-            matches = re.findall(pattern, full_text)
+        for pattern in _DATE_RES:
+            matches = pattern.findall(full_text)
             if matches:
                 # Use the first match as date
                 structured_data['date'] = matches[0]
@@ -121,37 +327,215 @@ class RekognitionService:
         return structured_data
 
 
+# Static prompt instructions are sent as each model's system instruction so only the
+# per-request content varies between calls, letting Gemini reuse the shared prefix
+RECEIPT_ANALYSIS_INSTRUCTIONS = """
+You are an expert at analyzing receipt images and extracting structured information for expense tracking.
+
+You will be given the OCR text from a receipt, and sometimes image metadata. Extract the following information in JSON format.
+
+Please return a JSON object with the following structure:
+{
+    "merchant_name": "Name of the business/merchant",
+    "total_amount": 123.45,
+    "currency": "CAD",
+    "date": "2024-01-15T12:30:00",
+    "items": [
+        {
+            "description": "Item description",
+            "quantity": 1,
+            "unit_price": 10.00,
+            "total_price": 10.00
+        }
+    ],
+    "tax_amount": 12.34,
+    "subtotal": 111.11,
+    "confidence_score": 0.85,
+    "notes": "Any additional observations or uncertainties"
+}
+
+Guidelines:
+- If a field cannot be determined, use null
+- For currency, use standard codes (CAD, USD, EUR, GBP)
+- For dates, use ISO format
+- Confidence score should be between 0.0 and 1.0
+- Be conservative with confidence scores if information is unclear
+"""
+
+TAX_ELIGIBILITY_INSTRUCTIONS = """
+You are a tax expert analyzing business expenses for tax deduction eligibility in Canada.
+
+For each expense you are given, return a JSON object with the following structure:
+{
+    "index": 0,
+    "tax_eligibility": "FULLY_DEDUCTIBLE|PARTIALLY_DEDUCTIBLE|NOT_DEDUCTIBLE|PERSONAL|REQUIRES_REVIEW",
+    "confidence": 0.85,
+    "reasoning": "Detailed explanation of the determination",
+    "suggestions": [
+        "Specific suggestions for improving tax compliance"
+    ],
+    "category_suggestion": "SUGGESTED_CATEGORY",
+    "notes": "Additional tax-related notes"
+}
+
+The "index" field is only required when several numbered expenses are given.
+
+Tax Eligibility Guidelines:
+- FULLY_DEDUCTIBLE: 100% deductible business expense
+- PARTIALLY_DEDUCTIBLE: 50% deductible (e.g., meals and entertainment)
+- NOT_DEDUCTIBLE: Not eligible for deduction
+- PERSONAL: Personal expense, not business-related
+- REQUIRES_REVIEW: Needs human review
+
+Consider:
+- Business purpose and necessity
+- Personal vs business use
+- CRA guidelines and restrictions
+- Documentation requirements
+"""
+
+EXPENSE_FILTERING_INSTRUCTIONS = """
+You are a tax expert reviewing a list of expenses for a tax filing and providing tax-related insights.
+
+Please return a JSON object with the following structure:
+{
+    "flagged_expenses": [
+        {
+            "expense_id": "id",
+            "issue": "Description of the issue",
+            "severity": "HIGH|MEDIUM|LOW",
+            "suggestion": "How to address the issue"
+        }
+    ],
+    "summary": "Overall summary of the expense list for tax purposes",
+    "suggestions": [
+        "General suggestions for tax optimization"
+    ],
+    "categories_analysis": {
+        "category": "Analysis of this category"
+    }
+}
+
+Focus on:
+- Expenses that may not be deductible
+- Missing documentation
+- Potential audit risks
+- Tax optimization opportunities
+- Compliance with CRA guidelines
+"""
+
+PROMPT_INSTRUCTIONS = {
+    'receipt': RECEIPT_ANALYSIS_INSTRUCTIONS,
+    'tax_eligibility': TAX_ELIGIBILITY_INSTRUCTIONS,
+    'expense_filtering': EXPENSE_FILTERING_INSTRUCTIONS,
+}
+
+
 class LLMService:
     def __init__(self):
-        self.model = None
+        # Empty until an API key is configured; doubles as the "is configured" check
+        self.models = {}
+        self.breaker = CircuitBreaker(settings.llm_breaker_fail_max, settings.llm_breaker_reset_seconds)
+        self._receipt_cache = TTLCache(maxsize=RECEIPT_CACHE_SIZE, ttl=RECEIPT_CACHE_TTL)
+        self._cache_lock = threading.Lock()
         
         if settings.google_api_key:
-            genai.configure(api_key=settings.google_api_key)
-            self.model = genai.GenerativeModel(settings.llm_model)
+            self._configure()
+            # gRPC channels don't survive fork(); a forked worker builds its own
+            os.register_at_fork(after_in_child=self._configure)
+    
+    def _configure(self):
+        """Create the Gemini client and per-kind models; the gRPC channel is shared by every thread"""
+        genai.configure(api_key=settings.google_api_key, transport='grpc')
+        self.models = {
+            kind: genai.GenerativeModel(
+                settings.llm_model,
+                system_instruction=instructions,
+                generation_config=LLM_GENERATION_CONFIG,
+            )
+            for kind, instructions in PROMPT_INSTRUCTIONS.items()
+        }
     
     def analyze_receipt(self, ocr_text: str, image_metadata: Optional[Dict[str, Any]] = None) -> ReceiptAnalysis:
         """Analyze receipt text using Google Gemini to extract structured information"""
-        if not self.model:
+        if not self.models:
             raise Exception("Google API key not configured")
         
+        cache_key = self._receipt_cache_key(ocr_text)
+        cached = self._get_cached_receipt(cache_key)
+        if cached:
+            return cached
+        
         prompt = self._create_receipt_analysis_prompt(ocr_text, image_metadata)
         
         try:
-            response = self._call_gemini(prompt)
-            return self._parse_receipt_analysis_response(response)
+            response = self._call_gemini(prompt, 'receipt')
+            analysis = self._parse_receipt_analysis_response(response)
+            self._cache_receipt(cache_key, analysis)
+            return analysis
         except Exception as e:
             # Fallback to basic analysis
             return self._fallback_analysis(ocr_text)
     
+    async def analyze_receipt_async(self, ocr_text: str,
+                                    image_metadata: Optional[Dict[str, Any]] = None) -> ReceiptAnalysis:
+        """Async variant of analyze_receipt; awaits Gemini without holding a thread"""
+        if not self.models:
+            raise Exception("Google API key not configured")
+        
+        cache_key = self._receipt_cache_key(ocr_text)
+        cached = self._get_cached_receipt(cache_key)
+        if cached:
+            return cached
+        
+        prompt = self._create_receipt_analysis_prompt(ocr_text, image_metadata)
+        
+        try:
+            response = await self._call_gemini_async(prompt, 'receipt')
+            analysis = self._parse_receipt_analysis_response(response)
+            self._cache_receipt(cache_key, analysis)
+            return analysis
+        except Exception:
+            # Fallback to basic analysis
+            return self._fallback_analysis(ocr_text)
+    
+    def _receipt_cache_key(self, ocr_text: str) -> bytes:
+        """Hash of the OCR text with case and whitespace differences folded away"""
+        normalized = ' '.join(ocr_text.lower().split())
+        return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+    
+    def _get_cached_receipt(self, cache_key: bytes) -> Optional[ReceiptAnalysis]:
+        with self._cache_lock:
+            cached = self._receipt_cache.get(cache_key)
+        # Callers may mutate what they get back, so hand out a copy
+        return cached.model_copy(deep=True) if cached else None
+    
+    def _cache_receipt(self, cache_key: bytes, analysis: ReceiptAnalysis):
+        if analysis.confidence_score <= FALLBACK_CONFIDENCE:
+            return
+        with self._cache_lock:
+            self._receipt_cache[cache_key] = analysis.model_copy(deep=True)
+    
+    async def analyze_receipts_batch(self, receipts: List[Tuple[str, Optional[Dict[str, Any]]]],
+                                     max_concurrency: int = 16) -> List[ReceiptAnalysis]:
+        """Analyze many (ocr_text, image_metadata) pairs with overlapping Gemini requests"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def bounded(ocr_text: str, image_metadata: Optional[Dict[str, Any]]) -> ReceiptAnalysis:
+            async with semaphore:
+                return await self.analyze_receipt_async(ocr_text, image_metadata)
+        
+        return await asyncio.gather(*[bounded(text, metadata) for text, metadata in receipts])
+    
     def analyze_expense_tax_eligibility(self, expense_data: Dict[str, Any]) -> Dict[str, Any]:
         """Analyze expense for tax eligibility using Google Gemini"""
-        if not self.model:
+        if not self.models:
             raise Exception("Google API key not configured")
         
         prompt = self._create_tax_eligibility_prompt(expense_data)
         
         try:
-            response = self._call_gemini(prompt)
+            response = self._call_gemini(prompt, 'tax_eligibility')
             return self._parse_tax_eligibility_response(response)
         except Exception as e:
             return {
@@ -161,16 +545,36 @@ class LLMService:
                 'suggestions': []
             }
     
+    def analyze_expenses_batch(self, expenses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Analyze several expenses for tax eligibility in a single Gemini call"""
+        if not self.models:
+            raise Exception("Google API key not configured")
+        
+        prompt = self._create_batch_tax_eligibility_prompt(expenses)
+        
+        try:
+            response = self._call_gemini(prompt, 'tax_eligibility')
+            return self._parse_batch_tax_eligibility_response(response, len(expenses))
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            return [{
+                'tax_eligibility': 'REQUIRES_REVIEW',
+                'confidence': 0.0,
+                'reasoning': f"LLM analysis failed: {str(e)}",
+                'suggestions': []
+            } for _ in expenses]
+    
     def filter_expenses_for_tax(self, expenses: List[Dict[str, Any]], 
                                tax_year: int, profile_type: str) -> Dict[str, Any]:
         """Filter and categorize expenses for tax purposes using Google Gemini"""
-        if not self.model:
+        if not self.models:
             raise Exception("Google API key not configured")
         
         prompt = self._create_expense_filtering_prompt(expenses, tax_year, profile_type)
         
         try:
-            response = self._call_gemini(prompt)
+            response = self._call_gemini(prompt, 'expense_filtering')
             return self._parse_expense_filtering_response(response)
         except Exception as e:
             return {
@@ -181,119 +585,51 @@ class LLMService:
     
     def _create_receipt_analysis_prompt(self, ocr_text: str, 
                                       image_metadata: Optional[Dict[str, Any]] = None) -> str:
-        """Create prompt for receipt analysis"""
+        """Create the per-receipt part of the receipt analysis prompt"""
         prompt = f"""
-You are an expert at analyzing receipt images and extracting structured information for expense tracking.
-
-Please analyze the following OCR text from a receipt and extract the following information in JSON format:
-
 OCR Text:
 {ocr_text}
 
 {self._format_image_metadata(image_metadata)}
-
-Please return a JSON object with the following structure:
-{{
-    "merchant_name": "Name of the business/merchant",
-    "total_amount": 123.45,
-    "currency": "CAD",
-    "date": "2024-01-15T12:30:00",
-    "items": [
-        {{
-            "description": "Item description",
-            "quantity": 1,
-            "unit_price": 10.00,
-            "total_price": 10.00
-        }}
-    ],
-    "tax_amount": 12.34,
-    "subtotal": 111.11,
-    "confidence_score": 0.85,
-    "notes": "Any additional observations or uncertainties"
-}}
-
-Guidelines:
-- If a field cannot be determined, use null
-- For currency, use standard codes (CAD, USD, EUR, GBP)
-- For dates, use ISO format
-- Confidence score should be between 0.0 and 1.0
-- Be conservative with confidence scores if information is unclear
 """
         return prompt
     
     def _create_tax_eligibility_prompt(self, expense_data: Dict[str, Any]) -> str:
-        """Create prompt for tax eligibility analysis"""
+        """Create the per-expense part of the tax eligibility prompt"""
         prompt = f"""
-You are a tax expert analyzing business expenses for tax deduction eligibility in Canada.
-
-Please analyze the following expense and determine its tax eligibility:
+Please analyze the following expense and determine its tax eligibility.
 
 Expense Details:
-{json.dumps(expense_data, indent=2)}
+{_prompt_json(expense_data)}
 
-Please return a JSON object with the following structure:
-{{
-    "tax_eligibility": "FULLY_DEDUCTIBLE|PARTIALLY_DEDUCTIBLE|NOT_DEDUCTIBLE|PERSONAL|REQUIRES_REVIEW",
-    "confidence": 0.85,
-    "reasoning": "Detailed explanation of the determination",
-    "suggestions": [
-        "Specific suggestions for improving tax compliance"
-    ],
-    "category_suggestion": "SUGGESTED_CATEGORY",
-    "notes": "Additional tax-related notes"
-}}
+Return a single JSON object.
+"""
+        return prompt
+    
+    def _create_batch_tax_eligibility_prompt(self, expenses: List[Dict[str, Any]]) -> str:
+        """Create the per-batch part of the tax eligibility prompt"""
+        expense_details = "\n".join(
+            f"Expense {index}:\n{_prompt_json(expense)}"
+            for index, expense in enumerate(expenses)
+        )
+        
+        prompt = f"""
+Please analyze each of the following {len(expenses)} expenses independently and determine its tax eligibility.
 
-Tax Eligibility Guidelines:
-- FULLY_DEDUCTIBLE: 100% deductible business expense
-- PARTIALLY_DEDUCTIBLE: 50% deductible (e.g., meals and entertainment)
-- NOT_DEDUCTIBLE: Not eligible for deduction
-- PERSONAL: Personal expense, not business-related
-- REQUIRES_REVIEW: Needs human review
+{expense_details}
 
-Consider:
-- Business purpose and necessity
-- Personal vs business use
-- CRA guidelines and restrictions
-- Documentation requirements
+Return a JSON array with exactly one object per expense, in the same order, each including its "index".
 """
         return prompt
     
     def _create_expense_filtering_prompt(self, expenses: List[Dict[str, Any]], 
                                        tax_year: int, profile_type: str) -> str:
-        """Create prompt for expense filtering and categorization"""
+        """Create the per-request part of the expense filtering prompt"""
         prompt = f"""
-You are a tax expert reviewing a list of expenses for {profile_type} tax filing for the year {tax_year}.
-
-Please analyze the following expenses and provide tax-related insights:
+Review the following expenses for {profile_type} tax filing for the year {tax_year}.
 
 Expenses:
-{json.dumps(expenses, indent=2)}
-
-Please return a JSON object with the following structure:
-{{
-    "flagged_expenses": [
-        {{
-            "expense_id": "id",
-            "issue": "Description of the issue",
-            "severity": "HIGH|MEDIUM|LOW",
-            "suggestion": "How to address the issue"
-        }}
-    ],
-    "summary": "Overall summary of the expense list for tax purposes",
-    "suggestions": [
-        "General suggestions for tax optimization"
-    ],
-    "categories_analysis": {{
-        "category": "Analysis of this category"
-    }}
-}}
-
-Focus on:
-- Expenses that may not be deductible
-- Missing documentation
-- Potential audit risks
-- Tax optimization opportunities
-- Compliance with CRA guidelines
+{_prompt_json(expenses)}
 """
         return prompt
     
@@ -302,41 +638,44 @@ Focus on:
         if not metadata:
             return ""
         
-        metadata_text = "\nImage Metadata:\n"
-        for key, value in metadata.items():
-            metadata_text += f"- {key}: {value}\n"
-        return metadata_text
+        return "\nImage Metadata:\n" + "".join(f"- {key}: {value}\n" for key, value in metadata.items())
     
-    def _call_gemini(self, prompt: str) -> str:
-        """Call Google Gemini API"""
+    def _call_gemini(self, prompt: str, kind: str) -> str:
+        """Call Google Gemini API with the model carrying the static instructions for `kind`"""
         try:
-            response = self.model.generate_content(prompt)
+            response = self.breaker.call(
+                self.models[kind].generate_content,
+                prompt,
+                request_options={"timeout": settings.llm_timeout_seconds}
+            )
             return response.text
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            raise Exception(f"Gemini API call failed: {str(e)}")
+    
+    async def _call_gemini_async(self, prompt: str, kind: str) -> str:
+        """Call Google Gemini API without blocking the event loop"""
+        try:
+            response = await self.breaker.call_async(
+                self.models[kind].generate_content_async,
+                prompt,
+                request_options={"timeout": settings.llm_timeout_seconds}
+            )
+            return response.text
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise Exception(f"Gemini API call failed: {str(e)}")
     
     def _parse_receipt_analysis_response(self, response: str) -> ReceiptAnalysis:
         """Parse Gemini response into ReceiptAnalysis object"""
         try:
-            # Extract JSON from response
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                data = json.loads(json_match.group())
-            else:
-                data = json.loads(response)
-            
-            return ReceiptAnalysis(
-                merchant_name=data.get('merchant_name'),
-                total_amount=data.get('total_amount'),
-                currency=data.get('currency'),
-                date=datetime.fromisoformat(data['date']) if data.get('date') else None,
-                items=data.get('items', []),
-                tax_amount=data.get('tax_amount'),
-                subtotal=data.get('subtotal'),
-                confidence_score=data.get('confidence_score', 0.5),
-                raw_text=response
-            )
+            data = _load_json(response, _JSON_OBJ_RE)
+            data.setdefault('confidence_score', 0.5)
+            data['raw_text'] = response
+            # pydantic-core coerces the ISO date and currency in one pass
+            return ReceiptAnalysis.model_validate(data)
         except Exception as e:
             # Fallback to basic analysis
             return self._fallback_analysis(response)
@@ -344,12 +683,7 @@ Focus on:
     def _parse_tax_eligibility_response(self, response: str) -> Dict[str, Any]:
         """Parse tax eligibility response"""
         try:
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                data = json.loads(json_match.group())
-            else:
-                data = json.loads(response)
+            data = _load_json(response, _JSON_OBJ_RE)
             
             return {
                 'tax_eligibility': data.get('tax_eligibility', 'REQUIRES_REVIEW'),
@@ -367,15 +701,41 @@ Focus on:
                 'suggestions': []
             }
     
+    def _parse_batch_tax_eligibility_response(self, response: str, count: int) -> List[Dict[str, Any]]:
+        """Parse a batched tax eligibility response, mapping results back by index"""
+        data = _load_json(response, _JSON_ARRAY_RE)
+        
+        by_index = {}
+        for position, entry in enumerate(data):
+            by_index[entry.get('index', position)] = entry
+        
+        results = []
+        for index in range(count):
+            entry = by_index.get(index)
+            if entry is None:
+                results.append({
+                    'tax_eligibility': 'REQUIRES_REVIEW',
+                    'confidence': 0.0,
+                    'reasoning': "No analysis returned for this expense",
+                    'suggestions': []
+                })
+                continue
+            
+            results.append({
+                'tax_eligibility': entry.get('tax_eligibility', 'REQUIRES_REVIEW'),
+                'confidence': entry.get('confidence', 0.5),
+                'reasoning': entry.get('reasoning', ''),
+                'suggestions': entry.get('suggestions', []),
+                'category_suggestion': entry.get('category_suggestion'),
+                'notes': entry.get('notes', '')
+            })
+        
+        return results
+    
     def _parse_expense_filtering_response(self, response: str) -> Dict[str, Any]:
         """Parse expense filtering response"""
         try:
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                data = json.loads(json_match.group())
-            else:
-                data = json.loads(response)
+            data = _load_json(response, _JSON_OBJ_RE)
             
             return {
                 'flagged_expenses': data.get('flagged_expenses', []),
@@ -400,7 +760,7 @@ Focus on:
             items=[],
             tax_amount=None,
             subtotal=None,
-            confidence_score=0.1,
+            confidence_score=FALLBACK_CONFIDENCE,
             raw_text=ocr_text
         )
 
@@ -413,21 +773,34 @@ class LocationService:
     def extract_location_from_exif(self, exif_data: Dict[str, Any]) -> Optional[Location]:
         """Extract location from EXIF data"""
         try:
-            if 'GPSInfo' in exif_data:
+            lat = lon = None
+            lat_tag = exif_data.get('GPS GPSLatitude')
+            lon_tag = exif_data.get('GPS GPSLongitude')
+            if lat_tag is not None and lon_tag is not None:
+                # exifread tags: values are lists of Ratio, refs are single letters
+                lat = self._convert_gps_to_decimal(
+                    lat_tag.values,
+                    str(exif_data.get('GPS GPSLatitudeRef', ''))
+                )
+                lon = self._convert_gps_to_decimal(
+                    lon_tag.values,
+                    str(exif_data.get('GPS GPSLongitudeRef', ''))
+                )
+            elif 'GPSInfo' in exif_data:
                 gps_info = exif_data['GPSInfo']
                 
                 # Extract latitude and longitude
                 lat = self._convert_gps_to_decimal(gps_info.get('GPSLatitude'), gps_info.get('GPSLatitudeRef'))
                 lon = self._convert_gps_to_decimal(gps_info.get('GPSLongitude'), gps_info.get('GPSLongitudeRef'))
-                
-                if lat and lon:
-                    return Location(
-                        latitude=lat,
-                        longitude=lon,
-                        source="exif"
-                    )
+            
+            if lat and lon:
+                return Location(
+                    latitude=lat,
+                    longitude=lon,
+                    source="exif"
+                )
         except Exception as e:
-            print(f"Error extracting EXIF location: {e}")
+            logger.warning("Error extracting EXIF location: %s", e)
         
         return None
     
@@ -437,7 +810,7 @@ class LocationService:
             return None
         
         degrees, minutes, seconds = gps_coords
-        decimal = degrees + (minutes / 60.0) + (seconds / 3600.0)
+        decimal = float(degrees) + (float(minutes) / 60.0) + (float(seconds) / 3600.0)
         
         if ref in ['S', 'W']:
             decimal = -decimal
@@ -453,37 +826,23 @@ class LocationService:
     def parse_location_from_text(self, text: str) -> Optional[Location]:
         """Parse location from text (OCR or manual input)"""
         # Basic location parsing - in production, you'd use a more sophisticated approach
-        import re
-        
-        # Look for common location patterns
-        patterns = [
-            r'(\d+\.\d+),\s*(\d+\.\d+)',  # lat,lon
-            r'(\w+),\s*(\w+),\s*(\w+)',   # city, province, country
-        ]
+        coordinates = _COORDINATES_RE.search(text)
+        if coordinates:
+            # Coordinates win over any address in the text
+            return Location(
+                latitude=float(coordinates.group('lat')),
+                longitude=float(coordinates.group('lon')),
+                source="ocr"
+            )
         
-        for pattern in patterns:
-            matches = re.findall(pattern, text)
-            if matches:
-                match = matches[0]
-                if len(match) == 2 and '.' in match[0] and '.' in match[1]:
-                    # Likely coordinates
-                    try:
-                        lat, lon = float(match[0]), float(match[1])
-                        return Location(
-                            latitude=lat,
-                            longitude=lon,
-                            source="ocr"
-                        )
-                    except ValueError:
-                        pass
-                elif len(match) >= 2:
-                    # Likely address components
-                    return Location(
-                        city=match[0] if len(match) > 0 else None,
-                        province=match[1] if len(match) > 1 else None,
-                        country=match[2] if len(match) > 2 else None,
-                        source="ocr"
-                    )
+        address = _ADDRESS_RE.search(text)
+        if address:
+            return Location(
+                city=address.group('city'),
+                province=address.group('province'),
+                country=address.group('country'),
+                source="ocr"
+            )
         
         return None
 
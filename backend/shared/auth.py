@@ -1,27 +1,55 @@
-import boto3
+import time
+import logging
+import hashlib
+import threading
 import jwt
+import bcrypt
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from passlib.context import CryptContext
+from cachetools import TTLCache
 from .config import settings
+from . import aws
 from .models import TokenData, User, UserCreate, UserResponse
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# bcrypt work factor for password hashes
+BCRYPT_ROUNDS = 12
+
+# Verified tokens are reused briefly, keyed by a hash of the token (never the raw token)
+TOKEN_CACHE_TTL = 30
+
+# Cognito user attributes change rarely
+COGNITO_USER_CACHE_TTL = 300
+
 
 class AuthService:
     def __init__(self):
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
         self.cognito_client = None
+        self._token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+        self._cognito_user_cache = TTLCache(maxsize=5000, ttl=COGNITO_USER_CACHE_TTL)
+        self._cache_lock = threading.Lock()
+        
+        # Encode the secret and build the allowed-algorithm list once rather than per token
+        self._jwt_key = settings.jwt_secret.encode() if settings.jwt_secret else None
+        self._jwt_algorithms = [settings.jwt_algorithm]
         
         if settings.cognito_user_pool_id:
-            self.cognito_client = boto3.client('cognito-idp', region_name=settings.aws_region)
+            self.cognito_client = aws.client('cognito-idp')
     
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """Verify a password against its hash"""
-        return self.pwd_context.verify(plain_password, hashed_password)
+        try:
+            return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+        except ValueError:
+            # Not a bcrypt hash
+            return False
     
     def get_password_hash(self, password: str) -> str:
         """Hash a password"""
-        return self.pwd_context.hash(password)
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
     
     def create_access_token(self, data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
         """Create a JWT access token"""
@@ -34,29 +62,42 @@ class AuthService:
         
         to_encode.update({"exp": expire})
         
-        if not settings.jwt_secret:
+        if not self._jwt_key:
             raise Exception("JWT secret not configured")
         
-        encoded_jwt = jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
+        encoded_jwt = jwt.encode(to_encode, self._jwt_key, algorithm=settings.jwt_algorithm)
         return encoded_jwt
     
     def verify_token(self, token: str) -> Optional[TokenData]:
-        """Verify and decode a JWT token"""
+        """Verify and decode a JWT token, reusing recent verifications"""
+        token_hash = hashlib.sha256(token.encode()).digest()[:16]
+        
+        with self._cache_lock:
+            token_data = self._token_cache.get(token_hash)
+        if token_data:
+            return token_data
+        
         try:
-            if not settings.jwt_secret:
+            if not self._jwt_key:
                 raise Exception("JWT secret not configured")
             
-            payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
+            payload = jwt.decode(token, self._jwt_key, algorithms=self._jwt_algorithms)
             user_id: str = payload.get("sub")
             email: str = payload.get("email")
             
             if user_id is None:
                 return None
             
-            token_data = TokenData(user_id=user_id, email=email)
-            return token_data
+            token_data = TokenData(user_id=user_id, email=email, exp=payload.get("exp"))
         except jwt.PyJWTError:
             return None
+        
+        # Don't cache tokens that expire before the cache entry would
+        if token_data.exp and token_data.exp - time.time() > TOKEN_CACHE_TTL:
+            with self._cache_lock:
+                self._token_cache[token_hash] = token_data
+        
+        return token_data
     
     def authenticate_user_cognito(self, email: str, password: str) -> Optional[Dict[str, Any]]:
         """Authenticate user using AWS Cognito"""
@@ -83,7 +124,7 @@ class AuthService:
             else:
                 return None
         except Exception as e:
-            print(f"Cognito authentication error: {e}")
+            logger.warning("Cognito authentication error: %s", e)
             return None
     
     def create_user_cognito(self, user_data: UserCreate) -> Optional[str]:
@@ -127,7 +168,7 @@ class AuthService:
             
             return response['User']['Username']
         except Exception as e:
-            print(f"Cognito user creation error: {e}")
+            logger.warning("Cognito user creation error: %s", e)
             return None
     
     def get_user_cognito(self, user_id: str) -> Optional[Dict[str, Any]]:
@@ -135,6 +176,11 @@ class AuthService:
         if not self.cognito_client:
             raise Exception("Cognito not configured")
         
+        with self._cache_lock:
+            cached = self._cognito_user_cache.get(user_id)
+        if cached:
+            return cached
+        
         try:
             response = self.cognito_client.admin_get_user(
                 UserPoolId=settings.cognito_user_pool_id,
@@ -145,7 +191,7 @@ class AuthService:
             for attr in response['UserAttributes']:
                 user_attributes[attr['Name']] = attr['Value']
             
-            return {
+            user = {
                 'id': response['Username'],
                 'email': user_attributes.get('email'),
                 'first_name': user_attributes.get('given_name'),
@@ -155,8 +201,12 @@ class AuthService:
                 'created_at': response.get('UserCreateDate'),
                 'updated_at': response.get('UserLastModifiedDate')
             }
+            
+            with self._cache_lock:
+                self._cognito_user_cache[user_id] = user
+            return user
         except Exception as e:
-            print(f"Cognito get user error: {e}")
+            logger.warning("Cognito get user error: %s", e)
             return None
     
     def refresh_token_cognito(self, refresh_token: str) -> Optional[Dict[str, Any]]:
@@ -181,7 +231,7 @@ class AuthService:
             else:
                 return None
         except Exception as e:
-            print(f"Cognito token refresh error: {e}")
+            logger.warning("Cognito token refresh error: %s", e)
             return None
     
     def change_password_cognito(self, access_token: str, old_password: str, new_password: str) -> bool:
@@ -197,7 +247,7 @@ class AuthService:
             )
             return True
         except Exception as e:
-            print(f"Cognito password change error: {e}")
+            logger.warning("Cognito password change error: %s", e)
             return False
     
     def forgot_password_cognito(self, email: str) -> bool:
@@ -212,7 +262,7 @@ class AuthService:
             )
             return True
         except Exception as e:
-            print(f"Cognito forgot password error: {e}")
+            logger.warning("Cognito forgot password error: %s", e)
             return False
     
     def confirm_forgot_password_cognito(self, email: str, confirmation_code: str, new_password: str) -> bool:
@@ -229,7 +279,7 @@ class AuthService:
             )
             return True
         except Exception as e:
-            print(f"Cognito confirm forgot password error: {e}")
+            logger.warning("Cognito confirm forgot password error: %s", e)
             return False
 
 
@@ -0,0 +1,31 @@
+import boto3
+from functools import lru_cache
+from botocore.config import Config
+from .config import settings
+
+
+# Shared botocore config: keep-alive connections sized for our thread pools
+boto_config = Config(
+    region_name=settings.aws_region,
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    # Fail fast on a dead connection rather than botocore's 60 s default; adaptive retries pick it up
+    connect_timeout=2,
+    read_timeout=10,
+    retries={'mode': 'adaptive', 'max_attempts': 5}
+)
+
+# One session per process so credentials are resolved and service models loaded once
+session = boto3.session.Session(region_name=settings.aws_region)
+
+
+@lru_cache(maxsize=None)
+def client(service_name: str):
+    """Get the shared low-level client for an AWS service, creating it on first use"""
+    return session.client(service_name, config=boto_config)
+
+
+@lru_cache(maxsize=None)
+def resource(service_name: str):
+    """Get the shared resource for an AWS service, creating it on first use"""
+    return session.resource(service_name, config=boto_config)
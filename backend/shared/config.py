@@ -1,9 +1,18 @@
 import os
-from typing import Optional
-from pydantic_settings import BaseSettings
+from functools import lru_cache
+from typing import Optional, Tuple, Union
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        case_sensitive=False,
+        frozen=True,
+        extra="ignore"
+    )
+    
     # AWS Configuration
     aws_region: str = "us-east-1"
     dynamodb_table: str = "taxless-expenses"
@@ -22,44 +31,71 @@ class Settings(BaseSettings):
     jwt_expiration_hours: int = 24
     
     # Application Settings
+    frontend_origin: str = "http://localhost:8080"
     default_currency: str = "CAD"
     max_file_size_mb: int = 10
-    supported_image_types: list = ["image/jpeg", "image/png", "image/heic"]
+    ocr_concurrency: int = os.cpu_count() or 4
+    # Also accepts a comma-separated string, as written in env.example
+    supported_image_types: Union[Tuple[str, ...], str] = ("image/jpeg", "image/png", "image/heic")
     
     # LLM Settings
     llm_model: str = "gemini-2.0-flash-exp"  # Google Gemini 2.0 Flash
     max_tokens: int = 2000
+    llm_timeout_seconds: int = 15
+    llm_breaker_fail_max: int = 5
+    llm_breaker_reset_seconds: int = 30
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = False
+    @field_validator("supported_image_types", mode="before")
+    @classmethod
+    def split_image_types(cls, value):
+        if isinstance(value, str):
+            return tuple(part.strip() for part in value.split(",") if part.strip())
+        return tuple(value)
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load settings once per process"""
+    return Settings()
 
 
 # Global settings instance
-settings = Settings()
+settings = get_settings()
 
 # DynamoDB Key Patterns
 class DynamoKeys:
+    # Builders inline these literals rather than looking the attributes up on every call;
+    # keep the two in sync
     USER_PREFIX = "USER#"
     PROFILE_PREFIX = "PROFILE#"
     EXPENSE_PREFIX = "EXPENSE#"
     RECEIPT_PREFIX = "RECEIPT#"
+    ANALYSIS_PREFIX = "ANALYSIS#"
+    TAX_ANALYSIS_PREFIX = "TAXANALYSIS#"
     
     @staticmethod
     def user_key(user_id: str) -> str:
-        return f"{DynamoKeys.USER_PREFIX}{user_id}"
+        return f"USER#{user_id}"
     
     @staticmethod
     def profile_key(user_id: str, profile_id: str) -> str:
-        return f"{DynamoKeys.PROFILE_PREFIX}{user_id}#{profile_id}"
+        return f"PROFILE#{user_id}#{profile_id}"
     
     @staticmethod
     def expense_key(user_id: str, expense_id: str) -> str:
-        return f"{DynamoKeys.EXPENSE_PREFIX}{user_id}#{expense_id}"
+        return f"EXPENSE#{user_id}#{expense_id}"
     
     @staticmethod
     def receipt_key(user_id: str, receipt_id: str) -> str:
-        return f"{DynamoKeys.RECEIPT_PREFIX}{user_id}#{receipt_id}"
+        return f"RECEIPT#{user_id}#{receipt_id}"
+    
+    @staticmethod
+    def analysis_cache_key(image_hash: str) -> str:
+        return f"ANALYSIS#{image_hash}"
+    
+    @staticmethod
+    def tax_analysis_cache_key(content_hash: str) -> str:
+        return f"TAXANALYSIS#{content_hash}"
     
     @staticmethod
     def user_profiles_sk(user_id: str) -> str:
@@ -72,6 +108,10 @@ class DynamoKeys:
     @staticmethod
     def expense_by_date_sk(date: str) -> str:
         return f"DATE#{date}"
+    
+    @staticmethod
+    def expense_by_profile_sk(profile_id: str, date: str) -> str:
+        return f"PROFILE#{profile_id}#DATE#{date}"
 
 
 # Expense Categories for tax purposes
@@ -1,51 +1,173 @@
-import boto3
-import json
-from typing import Dict, List, Optional, Any
+import time
+import logging
+import copy
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Any, Tuple
 from datetime import datetime
-from botocore.exceptions import ClientError
+from decimal import Decimal
+from functools import lru_cache
+from cachetools import TTLCache
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 from .config import settings, DynamoKeys
+from . import aws
 from .models import BaseEntity
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# BatchWriteItem limits and retry schedule for UnprocessedItems
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_MAX = 2.0
+
+# Opt-in read cache for get_item(use_cache=True); writes through this client invalidate it
+ITEM_CACHE_SIZE = 4096
+ITEM_CACHE_TTL = 30
+
+# BatchGetItem takes at most 100 keys; get_item_batched waits this long for company
+BATCH_GET_SIZE = 100
+BATCH_GET_WINDOW = 0.002
+
+# Only these attributes hold timestamps; every other string is returned as stored
+_DATETIME_FIELDS = frozenset({
+    'created_at', 'updated_at', 'date', 'processed_at', 'analyzed_at', 'generated_at'
+})
+
+
+def _parse_datetime(value: str) -> Any:
+    # fromisoformat accepts a trailing 'Z' natively on 3.11+ (the Lambda runtime)
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _serialize_value(value: Any) -> Any:
+    serializer = _SERIALIZERS.get(type(value))
+    if serializer is None:
+        return _serialize_subclass(value)
+    return serializer(value)
+
+
+def _serialize_subclass(value: Any) -> Any:
+    """Slow path for types not in _SERIALIZERS, e.g. str-based enums"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, dict):
+        return {k: _serialize_value(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_serialize_value(v) for v in value]
+    elif isinstance(value, (set, frozenset)):
+        return _serialize_set(value)
+    elif isinstance(value, float):
+        return Decimal(str(value))
+    elif isinstance(value, (int, str, bool, Decimal)):
+        return value
+    else:
+        return str(value)
+
+
+def _serialize_set(value: Any) -> Any:
+    # Stored as a DynamoDB set (SS for tags); sets can't be empty, so an empty one is stored as []
+    return {_serialize_value(v) for v in value} if value else []
+
+
+# Exact-type dispatch; one dict lookup instead of an isinstance chain per value
+_SERIALIZERS = {
+    dict: lambda value: {k: _serialize_value(v) for k, v in value.items()},
+    list: lambda value: [_serialize_value(v) for v in value],
+    set: _serialize_set,
+    frozenset: _serialize_set,
+    datetime: datetime.isoformat,
+    # The boto3 resource rejects floats; round-trip through str to keep the printed value
+    float: lambda value: Decimal(str(value)),
+    str: _identity,
+    int: _identity,
+    bool: _identity,
+    Decimal: _identity,
+    type(None): _identity,
+}
+
+
+# The plain client carries none of the resource's per-call shape walking; items are typed here instead
+_TYPE_SERIALIZER = TypeSerializer()
+_TYPE_DESERIALIZER = TypeDeserializer()
+
+
+def _to_wire(values: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: _TYPE_SERIALIZER.serialize(value) for key, value in values.items()}
+
+
+def _from_wire(values: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: _TYPE_DESERIALIZER.deserialize(value) for key, value in values.items()}
+
+
+@lru_cache(maxsize=256)
+def _compile_update(keys: Tuple[str, ...],
+                    remove: Tuple[str, ...] = ()) -> Tuple[str, Dict[str, str], Tuple[str, ...]]:
+    """SET (and REMOVE) expression, attribute names and value placeholders for a set of fields
+    
+    Callers update the same few field sets over and over, so these are built once per set.
+    The returned names dict is shared between calls and must not be modified.
+    """
+    update_expression = "SET " + ", ".join(f"#{key} = :{key}" for key in keys)
+    if remove:
+        update_expression += " REMOVE " + ", ".join(f"#{key}" for key in remove)
+    names = {f"#{key}": key for key in keys + remove}
+    return update_expression, names, tuple(f":{key}" for key in keys)
+
 
 class DynamoDBClient:
     def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb', region_name=settings.aws_region)
+        self.dynamodb = aws.resource('dynamodb')
         self.table = self.dynamodb.Table(settings.dynamodb_table)
-        self.client = boto3.client('dynamodb', region_name=settings.aws_region)
+        # Low-level client for the hot single-item and paginated reads/writes
+        self.client = aws.client('dynamodb')
+        self._batched_getter = BatchedGetter(self)
+        self._item_cache = TTLCache(maxsize=ITEM_CACHE_SIZE, ttl=ITEM_CACHE_TTL)
+        self._item_cache_lock = threading.Lock()
+        self._prewarm()
+    
+    def _prewarm(self):
+        """Open the keep-alive connection (TLS handshake included) during cold start"""
+        try:
+            # The resource and the low-level client keep separate connection pools
+            self.client.describe_table(TableName=settings.dynamodb_table)
+            self.dynamodb.meta.client.describe_table(TableName=settings.dynamodb_table)
+        except Exception as e:
+            logger.debug("DynamoDB prewarm failed: %s", e)
     
     def _serialize_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
         """Convert Python types to DynamoDB format"""
-        def serialize_value(value):
-            if isinstance(value, datetime):
-                return value.isoformat()
-            elif isinstance(value, dict):
-                return {k: serialize_value(v) for k, v in value.items()}
-            elif isinstance(value, list):
-                return [serialize_value(v) for v in value]
-            elif isinstance(value, (int, float, str, bool)) or value is None:
-                return value
-            else:
-                return str(value)
-        
-        return serialize_value(item)
+        return _serialize_value(item)
     
     def _deserialize_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
-        """Convert DynamoDB format to Python types"""
-        def deserialize_value(value):
-            if isinstance(value, dict):
-                return {k: deserialize_value(v) for k, v in value.items()}
-            elif isinstance(value, list):
-                return [deserialize_value(v) for v in value]
-            elif isinstance(value, str):
-                # Try to parse as datetime
-                try:
-                    return datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except (ValueError, TypeError):
-                    return value
-            else:
-                return value
-        
-        return deserialize_value(item)
+        """Convert DynamoDB format to Python types, parsing only the known timestamp fields
+        
+        Numbers come back from boto3 as Decimal; they become int or float so rows can go
+        straight into response models without validation.
+        """
+        # Items come fresh from boto3, so they are converted in place
+        stack = [item]
+        while stack:
+            container = stack.pop()
+            entries = container.items() if type(container) is dict else enumerate(container)
+            for key, value in entries:
+                value_type = type(value)
+                if value_type is dict or value_type is list:
+                    stack.append(value)
+                elif value_type is Decimal:
+                    container[key] = int(value) if value == value.to_integral_value() else float(value)
+                elif value_type is str and key in _DATETIME_FIELDS:
+                    container[key] = _parse_datetime(value)
+        return item
     
     def create_item(self, pk: str, sk: str, item_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create a new item in DynamoDB"""
@@ -56,78 +178,116 @@ class DynamoDBClient:
         }
         
         # Add timestamps if not present
-        if 'created_at' not in item:
-            item['created_at'] = datetime.utcnow().isoformat()
-        if 'updated_at' not in item:
-            item['updated_at'] = datetime.utcnow().isoformat()
+        now_iso = datetime.utcnow().isoformat()
+        item.setdefault('created_at', now_iso)
+        item.setdefault('updated_at', now_iso)
         
         serialized_item = self._serialize_item(item)
         
-        try:
-            self.table.put_item(Item=serialized_item)
-            return self._deserialize_item(serialized_item)
-        except ClientError as e:
-            raise Exception(f"Failed to create item: {str(e)}")
+        self.client.put_item(TableName=settings.dynamodb_table, Item=_to_wire(serialized_item))
+        self._invalidate(pk, sk)
+        return self._deserialize_item(serialized_item)
     
-    def get_item(self, pk: str, sk: str) -> Optional[Dict[str, Any]]:
-        """Get an item by primary key"""
-        try:
-            response = self.table.get_item(Key={'pk': pk, 'sk': sk})
-            item = response.get('Item')
-            if item:
-                return self._deserialize_item(item)
+    def get_item(self, pk: str, sk: str, use_cache: bool = False) -> Optional[Dict[str, Any]]:
+        """Get an item by primary key
+        
+        With use_cache, a copy held for up to ITEM_CACHE_TTL seconds may be returned. Writes from
+        other processes aren't seen until it expires, so only use it for rarely-changing items.
+        """
+        if use_cache:
+            with self._item_cache_lock:
+                cached = self._item_cache.get((pk, sk))
+            if cached is not None:
+                return copy.deepcopy(cached)
+        
+        response = self.client.get_item(
+            TableName=settings.dynamodb_table,
+            Key={'pk': {'S': pk}, 'sk': {'S': sk}}
+        )
+        item = response.get('Item')
+        if not item:
             return None
-        except ClientError as e:
-            raise Exception(f"Failed to get item: {str(e)}")
-    
-    def update_item(self, pk: str, sk: str, updates: Dict[str, Any]) -> Dict[str, Any]:
-        """Update an existing item"""
-        update_expression_parts = []
-        expression_attribute_names = {}
-        expression_attribute_values = {}
         
+        item = self._deserialize_item(_from_wire(item))
+        if use_cache:
+            with self._item_cache_lock:
+                self._item_cache[(pk, sk)] = copy.deepcopy(item)
+        return item
+    
+    def _invalidate(self, pk: str, sk: str):
+        with self._item_cache_lock:
+            self._item_cache.pop((pk, sk), None)
+    
+    def update_item(self, pk: str, sk: str, updates: Dict[str, Any],
+                    condition_expression: Optional[str] = None,
+                    condition_values: Optional[Dict[str, Any]] = None,
+                    remove: Tuple[str, ...] = (),
+                    condition_names: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Update an existing item, optionally only when a condition holds; remove drops attributes"""
         # Add updated_at timestamp
         updates['updated_at'] = datetime.utcnow().isoformat()
         
-        for key, value in updates.items():
-            if value is not None:  # Only update non-None values
-                attr_name = f"#{key}"
-                attr_value = f":{key}"
-                
-                update_expression_parts.append(f"{attr_name} = {attr_value}")
-                expression_attribute_names[attr_name] = key
-                expression_attribute_values[attr_value] = self._serialize_item({key: value})[key]
+        # Only update non-None values
+        fields = {key: value for key, value in updates.items() if value is not None}
+        update_expression, expression_attribute_names, value_names = _compile_update(tuple(fields), tuple(remove))
+        
+        update_params = {
+            'Key': {'pk': pk, 'sk': sk},
+            'UpdateExpression': update_expression,
+            'ExpressionAttributeNames': expression_attribute_names,
+            'ExpressionAttributeValues': {
+                value_name: _serialize_value(value)
+                for value_name, value in zip(value_names, fields.values())
+            },
+            'ReturnValues': "ALL_NEW"
+        }
         
-        if not update_expression_parts:
-            return self.get_item(pk, sk)
+        if condition_expression:
+            update_params['ConditionExpression'] = condition_expression
         
-        update_expression = "SET " + ", ".join(update_expression_parts)
+        if condition_names:
+            # The compiled names dict is shared, so merge into a copy
+            update_params['ExpressionAttributeNames'] = {**expression_attribute_names, **condition_names}
+        
+        if condition_values:
+            update_params['ExpressionAttributeValues'].update(condition_values)
         
         try:
-            response = self.table.update_item(
-                Key={'pk': pk, 'sk': sk},
-                UpdateExpression=update_expression,
-                ExpressionAttributeNames=expression_attribute_names,
-                ExpressionAttributeValues=expression_attribute_values,
-                ReturnValues="ALL_NEW"
-            )
-            return self._deserialize_item(response['Attributes'])
-        except ClientError as e:
-            raise Exception(f"Failed to update item: {str(e)}")
+            response = self.table.update_item(**update_params)
+        finally:
+            # A failed conditional write may still mean the cached copy is stale
+            self._invalidate(pk, sk)
+        return self._deserialize_item(response['Attributes'])
+    
+    def update_items(self, updates: List[Tuple[str, str, Dict[str, Any]]],
+                     max_workers: int = 32, remove: Tuple[str, ...] = (),
+                     condition_expression: Optional[str] = None) -> List[Optional[Exception]]:
+        """Apply many partial updates concurrently; returns the error (or None) for each"""
+        def apply(update: Tuple[str, str, Dict[str, Any]]) -> Optional[Exception]:
+            pk, sk, fields = update
+            try:
+                self.update_item(pk, sk, fields, condition_expression, remove=remove)
+                return None
+            except Exception as e:
+                return e
+        
+        if not updates:
+            return []
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(updates))) as executor:
+            return list(executor.map(apply, updates))
     
     def delete_item(self, pk: str, sk: str) -> bool:
         """Delete an item"""
-        try:
-            self.table.delete_item(Key={'pk': pk, 'sk': sk})
-            return True
-        except ClientError as e:
-            raise Exception(f"Failed to delete item: {str(e)}")
+        self.table.delete_item(Key={'pk': pk, 'sk': sk})
+        self._invalidate(pk, sk)
+        return True
     
-    def query_items(self, pk: str, sk_prefix: Optional[str] = None, 
-                   sk_condition: Optional[str] = None, sk_value: Optional[str] = None,
-                   limit: Optional[int] = None, 
-                   start_key: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        """Query items by partition key with optional sort key conditions"""
+    def _query_params(self, pk: str, sk_prefix: Optional[str], sk_condition: Optional[str],
+                      sk_value: Optional[str], filter_expression: Optional[str],
+                      expression_attribute_names: Optional[Dict[str, str]],
+                      expression_attribute_values: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build Query parameters for a partition key with optional sort key condition and filter"""
         query_params = {
             'KeyConditionExpression': 'pk = :pk',
             'ExpressionAttributeValues': {':pk': pk}
@@ -148,39 +308,99 @@ class DynamoDBClient:
             
             query_params['ExpressionAttributeValues'][':sk_value'] = sk_value
         
+        if filter_expression:
+            query_params['FilterExpression'] = filter_expression
+        
+        if expression_attribute_names:
+            query_params['ExpressionAttributeNames'] = expression_attribute_names
+        
+        if expression_attribute_values:
+            query_params['ExpressionAttributeValues'].update(expression_attribute_values)
+        
+        return query_params
+    
+    def query_items(self, pk: str, sk_prefix: Optional[str] = None, 
+                   sk_condition: Optional[str] = None, sk_value: Optional[str] = None,
+                   limit: Optional[int] = None, 
+                   start_key: Optional[Dict[str, Any]] = None,
+                   filter_expression: Optional[str] = None,
+                   expression_attribute_names: Optional[Dict[str, str]] = None,
+                   expression_attribute_values: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Query items by partition key with optional sort key conditions and filtering"""
+        query_params = self._query_params(
+            pk, sk_prefix, sk_condition, sk_value,
+            filter_expression, expression_attribute_names, expression_attribute_values
+        )
+        
         if limit:
             query_params['Limit'] = limit
         
         if start_key:
             query_params['ExclusiveStartKey'] = start_key
         
-        try:
-            response = self.table.query(**query_params)
-            items = [self._deserialize_item(item) for item in response.get('Items', [])]
-            
-            return {
-                'items': items,
-                'count': response.get('Count', 0),
-                'scanned_count': response.get('ScannedCount', 0),
-                'last_evaluated_key': response.get('LastEvaluatedKey'),
-                'has_more': 'LastEvaluatedKey' in response
-            }
-        except ClientError as e:
-            raise Exception(f"Failed to query items: {str(e)}")
+        response = self.table.query(**query_params)
+        items = [self._deserialize_item(item) for item in response.get('Items', [])]
+        
+        return {
+            'items': items,
+            'count': response.get('Count', 0),
+            'scanned_count': response.get('ScannedCount', 0),
+            'last_evaluated_key': response.get('LastEvaluatedKey'),
+            'has_more': 'LastEvaluatedKey' in response
+        }
     
-    def query_gsi(self, gsi_name: str, gsi_pk: str, gsi_sk_prefix: Optional[str] = None,
-                  limit: Optional[int] = None, 
-                  start_key: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        """Query items using a Global Secondary Index"""
+    def _gsi_query_params(self, gsi_name: str, gsi_pk: str, gsi_sk_prefix: Optional[str],
+                          filter_expression: Optional[str],
+                          expression_attribute_names: Optional[Dict[str, str]],
+                          expression_attribute_values: Optional[Dict[str, Any]],
+                          gsi_pk_attr: str, gsi_sk_attr: str,
+                          gsi_sk_condition: Optional[str], gsi_sk_value: Optional[str],
+                          projection_expression: Optional[str]) -> Dict[str, Any]:
+        """Build Query parameters for a Global Secondary Index"""
         query_params = {
             'IndexName': gsi_name,
-            'KeyConditionExpression': 'gsi1pk = :gsi_pk',
+            'KeyConditionExpression': f'{gsi_pk_attr} = :gsi_pk',
             'ExpressionAttributeValues': {':gsi_pk': gsi_pk}
         }
         
         if gsi_sk_prefix:
-            query_params['KeyConditionExpression'] += ' AND begins_with(gsi1sk, :gsi_sk_prefix)'
+            query_params['KeyConditionExpression'] += f' AND begins_with({gsi_sk_attr}, :gsi_sk_prefix)'
             query_params['ExpressionAttributeValues'][':gsi_sk_prefix'] = gsi_sk_prefix
+        elif gsi_sk_condition and gsi_sk_value:
+            if gsi_sk_condition in ('=', '>=', '<='):
+                query_params['KeyConditionExpression'] += f' AND {gsi_sk_attr} {gsi_sk_condition} :gsi_sk_value'
+            
+            query_params['ExpressionAttributeValues'][':gsi_sk_value'] = gsi_sk_value
+        
+        if projection_expression:
+            query_params['ProjectionExpression'] = projection_expression
+        
+        if filter_expression:
+            query_params['FilterExpression'] = filter_expression
+        
+        if expression_attribute_names:
+            query_params['ExpressionAttributeNames'] = expression_attribute_names
+        
+        if expression_attribute_values:
+            query_params['ExpressionAttributeValues'].update(expression_attribute_values)
+        
+        return query_params
+    
+    def query_gsi(self, gsi_name: str, gsi_pk: str, gsi_sk_prefix: Optional[str] = None,
+                  limit: Optional[int] = None, 
+                  start_key: Optional[Dict[str, Any]] = None,
+                  filter_expression: Optional[str] = None,
+                  expression_attribute_names: Optional[Dict[str, str]] = None,
+                  expression_attribute_values: Optional[Dict[str, Any]] = None,
+                  gsi_pk_attr: str = 'gsi1pk', gsi_sk_attr: str = 'gsi1sk',
+                  gsi_sk_condition: Optional[str] = None, gsi_sk_value: Optional[str] = None,
+                  projection_expression: Optional[str] = None) -> Dict[str, Any]:
+        """Query items using a Global Secondary Index with optional filtering"""
+        query_params = self._gsi_query_params(
+            gsi_name, gsi_pk, gsi_sk_prefix, filter_expression,
+            expression_attribute_names, expression_attribute_values,
+            gsi_pk_attr, gsi_sk_attr, gsi_sk_condition, gsi_sk_value, projection_expression
+        )
         
         if limit:
             query_params['Limit'] = limit
@@ -188,78 +408,186 @@ class DynamoDBClient:
         if start_key:
             query_params['ExclusiveStartKey'] = start_key
         
-        try:
-            response = self.table.query(**query_params)
-            items = [self._deserialize_item(item) for item in response.get('Items', [])]
-            
-            return {
-                'items': items,
-                'count': response.get('Count', 0),
-                'scanned_count': response.get('ScannedCount', 0),
-                'last_evaluated_key': response.get('LastEvaluatedKey'),
-                'has_more': 'LastEvaluatedKey' in response
-            }
-        except ClientError as e:
-            raise Exception(f"Failed to query GSI: {str(e)}")
+        response = self.table.query(**query_params)
+        items = [self._deserialize_item(item) for item in response.get('Items', [])]
+        
+        return {
+            'items': items,
+            'count': response.get('Count', 0),
+            'scanned_count': response.get('ScannedCount', 0),
+            'last_evaluated_key': response.get('LastEvaluatedKey'),
+            'has_more': 'LastEvaluatedKey' in response
+        }
     
-    def scan_items(self, filter_expression: Optional[str] = None,
-                  expression_attribute_names: Optional[Dict[str, str]] = None,
-                  expression_attribute_values: Optional[Dict[str, Any]] = None,
-                  limit: Optional[int] = None,
-                  start_key: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        """Scan items with optional filtering"""
+    def _scan_params(self, filter_expression: Optional[str],
+                     expression_attribute_names: Optional[Dict[str, str]],
+                     expression_attribute_values: Optional[Dict[str, Any]],
+                     projection_expression: Optional[str]) -> Dict[str, Any]:
+        """Build Scan parameters with optional filter and projection"""
         scan_params = {}
         
         if filter_expression:
             scan_params['FilterExpression'] = filter_expression
         
+        if projection_expression:
+            scan_params['ProjectionExpression'] = projection_expression
+        
         if expression_attribute_names:
             scan_params['ExpressionAttributeNames'] = expression_attribute_names
         
         if expression_attribute_values:
             scan_params['ExpressionAttributeValues'] = expression_attribute_values
         
+        return scan_params
+    
+    def scan_items(self, filter_expression: Optional[str] = None,
+                  expression_attribute_names: Optional[Dict[str, str]] = None,
+                  expression_attribute_values: Optional[Dict[str, Any]] = None,
+                  limit: Optional[int] = None,
+                  start_key: Optional[Dict[str, Any]] = None,
+                  projection_expression: Optional[str] = None,
+                  segment: Optional[int] = None,
+                  total_segments: Optional[int] = None) -> Dict[str, Any]:
+        """Scan items with optional filtering"""
+        scan_params = self._scan_params(
+            filter_expression, expression_attribute_names,
+            expression_attribute_values, projection_expression
+        )
+        
         if limit:
             scan_params['Limit'] = limit
         
         if start_key:
             scan_params['ExclusiveStartKey'] = start_key
         
-        try:
-            response = self.table.scan(**scan_params)
-            items = [self._deserialize_item(item) for item in response.get('Items', [])]
-            
-            return {
-                'items': items,
-                'count': response.get('Count', 0),
-                'scanned_count': response.get('ScannedCount', 0),
-                'last_evaluated_key': response.get('LastEvaluatedKey'),
-                'has_more': 'LastEvaluatedKey' in response
-            }
-        except ClientError as e:
-            raise Exception(f"Failed to scan items: {str(e)}")
-    
-    def batch_get_items(self, keys: List[Dict[str, str]]) -> List[Dict[str, Any]]:
-        """Get multiple items by their keys"""
-        try:
-            response = self.client.batch_get_item(
+        if total_segments:
+            scan_params['Segment'] = segment
+            scan_params['TotalSegments'] = total_segments
+        
+        response = self.table.scan(**scan_params)
+        items = [self._deserialize_item(item) for item in response.get('Items', [])]
+        
+        return {
+            'items': items,
+            'count': response.get('Count', 0),
+            'scanned_count': response.get('ScannedCount', 0),
+            'last_evaluated_key': response.get('LastEvaluatedKey'),
+            'has_more': 'LastEvaluatedKey' in response
+        }
+    
+    def iter_query(self, pk: str, sk_prefix: Optional[str] = None,
+                   sk_condition: Optional[str] = None, sk_value: Optional[str] = None,
+                   filter_expression: Optional[str] = None,
+                   expression_attribute_names: Optional[Dict[str, str]] = None,
+                   expression_attribute_values: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """Yield every item matching a query across all pages, one page held at a time"""
+        yield from self._paginate('query', self._query_params(
+            pk, sk_prefix, sk_condition, sk_value,
+            filter_expression, expression_attribute_names, expression_attribute_values
+        ))
+    
+    def iter_query_gsi(self, gsi_name: str, gsi_pk: str, gsi_sk_prefix: Optional[str] = None,
+                       filter_expression: Optional[str] = None,
+                       expression_attribute_names: Optional[Dict[str, str]] = None,
+                       expression_attribute_values: Optional[Dict[str, Any]] = None,
+                       gsi_pk_attr: str = 'gsi1pk', gsi_sk_attr: str = 'gsi1sk',
+                       gsi_sk_condition: Optional[str] = None, gsi_sk_value: Optional[str] = None,
+                       projection_expression: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield every item matching a GSI query across all pages, one page held at a time"""
+        yield from self._paginate('query', self._gsi_query_params(
+            gsi_name, gsi_pk, gsi_sk_prefix, filter_expression,
+            expression_attribute_names, expression_attribute_values,
+            gsi_pk_attr, gsi_sk_attr, gsi_sk_condition, gsi_sk_value, projection_expression
+        ))
+    
+    def iter_scan(self, filter_expression: Optional[str] = None,
+                  expression_attribute_names: Optional[Dict[str, str]] = None,
+                  expression_attribute_values: Optional[Dict[str, Any]] = None,
+                  projection_expression: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield every item of a scan across all pages, one page held at a time"""
+        yield from self._paginate('scan', self._scan_params(
+            filter_expression, expression_attribute_names,
+            expression_attribute_values, projection_expression
+        ))
+    
+    def _paginate(self, operation: str, params: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        if 'ExpressionAttributeValues' in params:
+            params['ExpressionAttributeValues'] = _to_wire(params['ExpressionAttributeValues'])
+        
+        paginator = self.client.get_paginator(operation)
+        for page in paginator.paginate(TableName=settings.dynamodb_table, **params):
+            for item in page.get('Items', []):
+                yield self._deserialize_item(_from_wire(item))
+    
+    def parallel_scan(self, total_segments: int = 8, **scan_kwargs) -> List[Dict[str, Any]]:
+        """Scan the whole table with one worker per segment and merge the results"""
+        def scan_segment(segment: int) -> List[Dict[str, Any]]:
+            items = []
+            start_key = None
+            while True:
+                result = self.scan_items(
+                    start_key=start_key,
+                    segment=segment,
+                    total_segments=total_segments,
+                    **scan_kwargs
+                )
+                items.extend(result['items'])
+                start_key = result['last_evaluated_key']
+                if not start_key:
+                    return items
+        
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(scan_segment, range(total_segments))
+            return [item for segment_items in segments for item in segment_items]
+    
+    def batch_get_items(self, keys: List[Dict[str, str]], max_workers: int = 8) -> List[Dict[str, Any]]:
+        """Get multiple items by their keys; chunks of BATCH_GET_SIZE keys are fetched concurrently"""
+        # A request may not name the same key twice
+        keys = list({(key['pk'], key['sk']): key for key in keys}.values())
+        chunks = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+        if len(chunks) <= 1:
+            return self._get_chunk(chunks[0]) if chunks else []
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            return [item for chunk_items in executor.map(self._get_chunk, chunks) for item in chunk_items]
+    
+    def _get_chunk(self, keys: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Get one batch, retrying UnprocessedKeys with exponential backoff"""
+        items = []
+        request = {'Keys': keys}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            response = self.dynamodb.batch_get_item(
                 RequestItems={
-                    settings.dynamodb_table: {
-                        'Keys': keys
-                    }
+                    settings.dynamodb_table: request
                 }
             )
-            
-            items = response['Responses'].get(settings.dynamodb_table, [])
-            return [self._deserialize_item(item) for item in items]
-        except ClientError as e:
-            raise Exception(f"Failed to batch get items: {str(e)}")
+            items.extend(response['Responses'].get(settings.dynamodb_table, []))
+            request = response.get('UnprocessedKeys', {}).get(settings.dynamodb_table)
+            if not request:
+                return [self._deserialize_item(item) for item in items]
+            time.sleep(min(BATCH_BACKOFF_BASE * (2 ** attempt), BATCH_BACKOFF_MAX))
+        
+        raise Exception(f"{len(request['Keys'])} batch get keys still unprocessed after {BATCH_MAX_ATTEMPTS} attempts")
+    
+    def deserialize_stream_image(self, image: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert a DynamoDB Streams NewImage/OldImage into the same shape get_item returns"""
+        return self._deserialize_item(_from_wire(image))
+    
+    def get_item_batched(self, pk: str, sk: str) -> Optional[Dict[str, Any]]:
+        """Like get_item, but coalesced with concurrent callers' reads into one BatchGetItem"""
+        return self._batched_getter.get(pk, sk).result()
     
-    def batch_write_items(self, items: List[Dict[str, Any]], operation: str = 'put') -> Dict[str, Any]:
+    def batch_write_items(self, items: List[Dict[str, Any]], operation: str = 'put',
+                          max_workers: int = 16) -> Dict[str, Any]:
         """Write multiple items in batch"""
         if operation not in ['put', 'delete']:
             raise ValueError("Operation must be 'put' or 'delete'")
         
+        # A batch may not name the same key twice; the last write for a key wins
+        items = list({(item['pk'], item['sk']): item for item in items}.values())
+        for item in items:
+            self._invalidate(item['pk'], item['sk'])
+        
         batch_items = []
         for item in items:
             if operation == 'put':
@@ -278,22 +606,88 @@ class DynamoDBClient:
                     }
                 })
         
-        # DynamoDB batch operations are limited to 25 items
-        results = []
-        for i in range(0, len(batch_items), 25):
-            batch = batch_items[i:i+25]
-            
-            try:
-                response = self.client.batch_write_item(
-                    RequestItems={
-                        settings.dynamodb_table: batch
-                    }
-                )
-                results.append(response)
-            except ClientError as e:
-                raise Exception(f"Failed to batch write items: {str(e)}")
+        # DynamoDB batch operations are limited to 25 items; the chunks go out concurrently
+        chunks = [batch_items[i:i + BATCH_WRITE_SIZE] for i in range(0, len(batch_items), BATCH_WRITE_SIZE)]
+        if not chunks:
+            return {'results': []}
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            results = list(executor.map(self._write_chunk, chunks))
         
         return {'results': results}
+    
+    def _write_chunk(self, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Write one batch, resubmitting UnprocessedItems with exponential backoff"""
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            response = self.dynamodb.batch_write_item(
+                RequestItems={
+                    settings.dynamodb_table: requests
+                }
+            )
+            requests = response.get('UnprocessedItems', {}).get(settings.dynamodb_table)
+            if not requests:
+                return response
+            time.sleep(min(BATCH_BACKOFF_BASE * (2 ** attempt), BATCH_BACKOFF_MAX))
+        
+        raise Exception(f"{len(requests)} batch write requests still unprocessed after {BATCH_MAX_ATTEMPTS} attempts")
+
+
+class BatchedGetter:
+    """Collects get requests arriving within a short window and serves them with one BatchGetItem"""
+    
+    def __init__(self, client: DynamoDBClient, window: float = BATCH_GET_WINDOW,
+                 max_keys: int = BATCH_GET_SIZE):
+        self._client = client
+        self._window = window
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        self._timer: Optional[threading.Timer] = None
+    
+    def get(self, pk: str, sk: str) -> Future:
+        """Queue a read; the future resolves to the item, or None if it doesn't exist"""
+        full = None
+        with self._lock:
+            future = self._pending.get((pk, sk))
+            if future is None:
+                future = self._pending[(pk, sk)] = Future()
+                if len(self._pending) >= self._max_keys:
+                    full = self._take_pending()
+                elif self._timer is None:
+                    self._timer = threading.Timer(self._window, self._flush_pending)
+                    self._timer.daemon = True
+                    self._timer.start()
+        
+        # A full batch goes out right away on the caller's thread
+        if full:
+            self._flush(full)
+        return future
+    
+    def _take_pending(self) -> Dict[Tuple[str, str], Future]:
+        # Caller holds the lock
+        pending, self._pending = self._pending, {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return pending
+    
+    def _flush_pending(self):
+        with self._lock:
+            pending = self._take_pending()
+        if pending:
+            self._flush(pending)
+    
+    def _flush(self, pending: Dict[Tuple[str, str], Future]):
+        try:
+            items = self._client.batch_get_items([{'pk': pk, 'sk': sk} for pk, sk in pending])
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+            return
+        
+        found = {(item['pk'], item['sk']): item for item in items}
+        for key, future in pending.items():
+            future.set_result(found.get(key))
 
 
 # Global database client instance
@@ -1,16 +1,16 @@
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-from enum import Enum
-from pydantic import BaseModel, Field, validator
+from typing import Optional, List, Dict, Any, Set
+from enum import StrEnum
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 import uuid
 
 
-class TaxProfileType(str, Enum):
+class TaxProfileType(StrEnum):
     PERSONAL = "personal"
     BUSINESS = "business"
 
 
-class ExpenseCategory(str, Enum):
+class ExpenseCategory(StrEnum):
     MEALS_ENTERTAINMENT = "MEALS_ENTERTAINMENT"
     TRAVEL = "TRAVEL"
     OFFICE_SUPPLIES = "OFFICE_SUPPLIES"
@@ -27,7 +27,7 @@ class ExpenseCategory(str, Enum):
     OTHER = "OTHER"
 
 
-class TaxEligibility(str, Enum):
+class TaxEligibility(StrEnum):
     FULLY_DEDUCTIBLE = "FULLY_DEDUCTIBLE"
     PARTIALLY_DEDUCTIBLE = "PARTIALLY_DEDUCTIBLE"
     NOT_DEDUCTIBLE = "NOT_DEDUCTIBLE"
@@ -35,22 +35,28 @@ class TaxEligibility(str, Enum):
     REQUIRES_REVIEW = "REQUIRES_REVIEW"
 
 
-class Currency(str, Enum):
+class Currency(StrEnum):
     CAD = "CAD"
     USD = "USD"
     EUR = "EUR"
     GBP = "GBP"
 
 
+# Models holding enums store their plain values, so dumps hand DynamoDB and JSON ordinary strings
+ENUM_VALUES_CONFIG = ConfigDict(use_enum_values=True)
+
+
+def new_id() -> str:
+    """Random entity id: a uuid4 as 32 hex chars, skipping the dashed str() formatting"""
+    return uuid.uuid4().hex
+
+
 # Base Models
 class BaseEntity(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # Stamped by DynamoDBClient.create_item/update_item on write; loaded rows keep the stored value
     updated_at: datetime = Field(default_factory=datetime.utcnow)
-    
-    @validator('updated_at', pre=True, always=True)
-    def set_updated_at(cls, v):
-        return datetime.utcnow()
 
 
 # User Models
@@ -87,6 +93,8 @@ class User(BaseEntity):
 
 # Tax Profile Models
 class TaxProfileCreate(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     name: str = Field(..., description="Profile name (e.g., 'Personal', 'Company ABC')")
     profile_type: TaxProfileType
     default_currency: Currency = Currency.CAD
@@ -97,6 +105,8 @@ class TaxProfileCreate(BaseModel):
 
 
 class TaxProfileUpdate(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     name: Optional[str] = None
     profile_type: Optional[TaxProfileType] = None
     default_currency: Optional[Currency] = None
@@ -106,6 +116,8 @@ class TaxProfileUpdate(BaseModel):
 
 
 class TaxProfile(BaseEntity):
+    model_config = ENUM_VALUES_CONFIG
+    
     user_id: str
     name: str
     profile_type: TaxProfileType
@@ -117,6 +129,8 @@ class TaxProfile(BaseEntity):
 
 
 class TaxProfileResponse(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     id: str
     name: str
     profile_type: TaxProfileType
@@ -142,6 +156,8 @@ class Location(BaseModel):
 
 # Receipt Models
 class ReceiptAnalysis(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     merchant_name: Optional[str] = None
     total_amount: Optional[float] = None
     currency: Optional[Currency] = None
@@ -151,6 +167,12 @@ class ReceiptAnalysis(BaseModel):
     subtotal: Optional[float] = None
     confidence_score: float = Field(..., ge=0.0, le=1.0)
     raw_text: str = Field(..., description="Raw OCR text from receipt")
+    
+    @field_validator('date', mode='before')
+    @classmethod
+    def blank_date_to_none(cls, v):
+        # The model sometimes answers "" or null for an unreadable date
+        return v or None
 
 
 class Receipt(BaseEntity):
@@ -166,6 +188,8 @@ class Receipt(BaseEntity):
 
 # Expense Models
 class ExpenseCreate(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     profile_id: str = Field(..., description="Tax profile ID")
     amount: float = Field(..., gt=0, description="Expense amount")
     currency: Currency = Currency.CAD
@@ -175,11 +199,13 @@ class ExpenseCreate(BaseModel):
     location: Optional[Location] = None
     tax_eligibility: TaxEligibility = TaxEligibility.REQUIRES_REVIEW
     notes: Optional[str] = None
-    tags: List[str] = Field(default_factory=list)
+    tags: Set[str] = Field(default_factory=set)
     receipt_ids: List[str] = Field(default_factory=list)
 
 
 class ExpenseUpdate(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     amount: Optional[float] = Field(None, gt=0)
     currency: Optional[Currency] = None
     description: Optional[str] = None
@@ -188,11 +214,13 @@ class ExpenseUpdate(BaseModel):
     location: Optional[Location] = None
     tax_eligibility: Optional[TaxEligibility] = None
     notes: Optional[str] = None
-    tags: Optional[List[str]] = None
+    tags: Optional[Set[str]] = None
     receipt_ids: Optional[List[str]] = None
 
 
 class Expense(BaseEntity):
+    model_config = ENUM_VALUES_CONFIG
+    
     user_id: str
     profile_id: str
     amount: float
@@ -203,13 +231,15 @@ class Expense(BaseEntity):
     location: Optional[Location] = None
     tax_eligibility: TaxEligibility
     notes: Optional[str] = None
-    tags: List[str] = Field(default_factory=list)
+    tags: Set[str] = Field(default_factory=set)
     receipt_ids: List[str] = Field(default_factory=list)
     is_verified: bool = False
     llm_analysis: Optional[Dict[str, Any]] = None
 
 
 class ExpenseResponse(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     id: str
     profile_id: str
     amount: float
@@ -227,8 +257,28 @@ class ExpenseResponse(BaseModel):
     updated_at: datetime
 
 
+# Expense amounts are stored in DynamoDB as integer cents
+def amount_to_cents(amount: float) -> int:
+    """Convert a currency amount to integer cents"""
+    return int(round(amount * 100))
+
+
+def cents_to_amount(cents: int) -> float:
+    """Convert integer cents back to a currency amount"""
+    return cents / 100
+
+
+def expense_amount_cents(item: Dict[str, Any]) -> int:
+    """Read a stored expense's amount in cents, falling back to the legacy dollar `amount`"""
+    if 'amount_cents' in item:
+        return int(item['amount_cents'])
+    return amount_to_cents(float(item.get('amount', 0)))
+
+
 # Report Models
 class ExpenseFilter(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     profile_ids: Optional[List[str]] = None
     categories: Optional[List[ExpenseCategory]] = None
     date_from: Optional[datetime] = None
@@ -241,6 +291,8 @@ class ExpenseFilter(BaseModel):
 
 
 class ExpenseSummary(BaseModel):
+    model_config = ENUM_VALUES_CONFIG
+    
     total_expenses: int
     total_amount: float
     currency: Currency
@@ -274,6 +326,7 @@ class PaginatedResponse(BaseModel):
     page_size: int
     has_next: bool
     has_prev: bool
+    next_cursor: Optional[str] = None
 
 
 # Authentication Models
@@ -286,4 +339,5 @@ class TokenResponse(BaseModel):
 
 class TokenData(BaseModel):
     user_id: Optional[str] = None
-    email: Optional[str] = None 
\ No newline at end of file
+    email: Optional[str] = None
+    exp: Optional[int] = None 
\ No newline at end of file